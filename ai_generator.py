@@ -2,89 +2,52 @@
 AI widget generator - generates HTML/CSS from data and prompt using Claude 3.5 Sonnet.
 """
 
-import json
 import re
+import time
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Any
-from anthropic import Anthropic
-from config import ANTHROPIC_API_KEY
+import hashlib
+import logging
+from collections import OrderedDict
+from html import escape
+from typing import Dict, Any, AsyncIterable, Optional
+import orjson
+from anthropic import AsyncAnthropic
+from config import ANTHROPIC_API_KEY, MAX_CONCURRENT_GENERATIONS, WIDGET_CACHE_TTL, WIDGET_CACHE_SIZE
 
-# Thread pool executor for running blocking Anthropic API calls
-_executor = ThreadPoolExecutor(max_workers=5)
+logger = logging.getLogger(__name__)
 
+# Shared async client, created on first use; its HTTP connection pool is reused across generations
+_async_client: Optional[AsyncAnthropic] = None
 
-async def generate_widget_html(data: Dict[str, Any], render_prompt: str, is_user_prompt: bool = False) -> str:
-    """
-    Generate widget HTML/CSS using Claude 3.5 Sonnet based on data and render prompt.
-    
-    Args:
-        data: The dataset to render
-        render_prompt: Instructions on how to render the data
-        
-    Returns:
-        HTML string for the widget (with embedded CSS in <style> tag)
-    """
-    # Check if API key is configured
-    if not ANTHROPIC_API_KEY:
-        return """
-        <div class="widget-error" style="padding: 20px; color: #d32f2f; background: #ffebee; border-radius: 8px;">
-            <h3>⚠️ Configuration Error</h3>
-            <p>ANTHROPIC_API_KEY is not set. Please add it to your .env file.</p>
-            <p>Get your API key from <a href="https://console.anthropic.com" target="_blank">console.anthropic.com</a></p>
-        </div>
-        """
-    
-    try:
-        # Build the prompt based on whether it's a user prompt (no data) or app prompt (with data)
-        if is_user_prompt or not data:
-            # User prompt - direct request to AI, no data provided
-            # Check if the prompt contains style preservation instructions
-            has_style_preservation = "CRITICAL STYLE PRESERVATION" in render_prompt or "CURRENT WIDGET STYLES" in render_prompt
-            
-            if has_style_preservation:
-                # Style preservation mode - emphasize keeping existing styles
-                prompt = f"""Generate a complete, production-ready widget based on the following user request.
-
-USER REQUEST:
-{render_prompt}
-
-CRITICAL INSTRUCTIONS:
-- Follow the style preservation requirements EXACTLY as specified above
-- If CSS styles are provided in the request, USE THEM EXACTLY or create very similar styles
+
+def _get_client() -> AsyncAnthropic:
+    """Return the shared Anthropic client, creating it on first use."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+    return _async_client
+
+
+async def close_anthropic_client() -> None:
+    """Close the shared Anthropic client and its connection pool (called on shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+# Shared instruction blocks for the system prompts below
+_STYLE_PRESERVATION_INSTRUCTIONS = """CRITICAL INSTRUCTIONS:
+- Follow the style preservation requirements in the {source} EXACTLY as specified
+- If CSS styles are provided in the {source}, USE THEM EXACTLY or create very similar styles
 - Preserve colors, fonts, spacing, layout, and all visual properties
 - Only update the content/data, NOT the styling
 - Keep the same visual appearance and design aesthetic
 
-REQUIREMENTS:
-- The widget should be visually appealing and fulfill the user's request
-- Use modern CSS (flexbox/grid, responsive design)
-- Ensure the widget is self-contained (all styles inline or in a <style> tag)
-- Make it responsive and accessible
-- Use semantic HTML
-- The widget should be ready to inject into a dashboard
-- CRITICAL: All CSS must be scoped to the widget content only - use class names that won't conflict with dashboard styles
-- Avoid global styles, body/html selectors, or styles that affect elements outside the widget
-- Use inline styles or scoped <style> tags within the widget HTML
-- If the request requires real data (like weather, schedules, etc.), generate the widget with realistic/sample data that matches the request
-- Make the widget functional and complete
-
-IMPORTANT: 
-- Return COMPLETE, FUNCTIONAL HTML code with ALL content elements (divs, spans, text, etc.)
-- Include the full HTML structure with styles AND the actual content
-- Do not include any explanatory text, descriptions, or notes before or after the HTML
-- The HTML must be complete and display actual content
-- PRESERVE THE STYLES AS SPECIFIED IN THE USER REQUEST
-
-Return the complete widget HTML code now:"""
-            else:
-                # Normal generation mode
-                prompt = f"""Generate a complete, production-ready widget based on the following user request.
+"""
 
-USER REQUEST:
-{render_prompt}
+_USER_PROMPT_SYSTEM = """Generate a complete, production-ready widget based on the user request.
 
-REQUIREMENTS:
+{style_instructions}REQUIREMENTS:
 - The widget should be visually appealing and fulfill the user's request
 - Use modern CSS (flexbox/grid, responsive design)
 - Ensure the widget is self-contained (all styles inline or in a <style> tag)
@@ -101,32 +64,11 @@ IMPORTANT:
 - Return COMPLETE, FUNCTIONAL HTML code with ALL content elements (divs, spans, text, etc.)
 - Include the full HTML structure with styles AND the actual content
 - Do not include any explanatory text, descriptions, or notes before or after the HTML
-- The HTML must be complete and display actual content
+- The HTML must be complete and display actual content{style_footer}"""
 
-Return the complete widget HTML code now:"""
-        else:
-            # App prompt - with provided data
-            # Check if the prompt contains style preservation instructions
-            has_style_preservation = "CRITICAL STYLE PRESERVATION" in render_prompt or "CURRENT WIDGET STYLES" in render_prompt
-            
-            if has_style_preservation:
-                # Style preservation mode - emphasize keeping existing styles
-                prompt = f"""Generate a complete, production-ready widget based on the following data and rendering instructions.
-
-DATA TO RENDER:
-{json.dumps(data, indent=2)}
-
-RENDERING INSTRUCTIONS:
-{render_prompt}
-
-CRITICAL INSTRUCTIONS:
-- Follow the style preservation requirements EXACTLY as specified above
-- If CSS styles are provided in the rendering instructions, USE THEM EXACTLY or create very similar styles
-- Preserve colors, fonts, spacing, layout, and all visual properties
-- Only update the content/data, NOT the styling
-- Keep the same visual appearance and design aesthetic
+_APP_PROMPT_SYSTEM = """Generate a complete, production-ready widget based on the provided data and rendering instructions.
 
-REQUIREMENTS:
+{style_instructions}REQUIREMENTS:
 - The widget should be visually appealing and match the rendering instructions
 - Use modern CSS (flexbox/grid, responsive design)
 - Ensure the widget is self-contained (all styles inline or in a <style> tag)
@@ -141,221 +83,392 @@ IMPORTANT:
 - Return COMPLETE, FUNCTIONAL HTML code with ALL content elements (divs, spans, text, etc.)
 - Include the full HTML structure with styles AND the actual content displaying the data
 - Do not include any explanatory text, descriptions, or notes before or after the HTML
-- The HTML must display the actual data values, not just styles
-- PRESERVE THE STYLES AS SPECIFIED IN THE RENDERING INSTRUCTIONS
+- The HTML must display the actual data values, not just styles{style_footer}"""
+
+# System prompts keyed by (is_user_prompt, has_style_preservation), built once at import
+_SYSTEM_PROMPTS = {
+    (True, False): _USER_PROMPT_SYSTEM.format(style_instructions="", style_footer=""),
+    (True, True): _USER_PROMPT_SYSTEM.format(
+        style_instructions=_STYLE_PRESERVATION_INSTRUCTIONS.format(source="user request"),
+        style_footer="\n- PRESERVE THE STYLES AS SPECIFIED IN THE USER REQUEST"
+    ),
+    (False, False): _APP_PROMPT_SYSTEM.format(style_instructions="", style_footer=""),
+    (False, True): _APP_PROMPT_SYSTEM.format(
+        style_instructions=_STYLE_PRESERVATION_INSTRUCTIONS.format(source="rendering instructions"),
+        style_footer="\n- PRESERVE THE STYLES AS SPECIFIED IN THE RENDERING INSTRUCTIONS"
+    ),
+}
+
+# Fixed parts of the per-request user message; only the data and render prompt are filled in
+_USER_REQUEST_HEADER = "USER REQUEST:\n"
+_DATA_HEADER = "DATA TO RENDER:\n"
+_INSTRUCTIONS_HEADER = "\n\nRENDERING INSTRUCTIONS:\n"
+_PROMPT_FOOTER = "\n\nReturn the complete widget HTML code now:"
+
+# Prompt DATA block format (non-string keys are stringified like json.dumps does)
+_DATA_JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+# Generated HTML keyed by request hash -> (expires_at, html), oldest first
+_widget_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+
+def _cache_key(is_user_prompt: bool, render_prompt: str, data_json: str) -> str:
+    """Build an exact-match cache key for a generation request."""
+    return hashlib.sha256(f"{is_user_prompt}|{render_prompt}|{data_json}".encode("utf-8")).hexdigest()
+
+
+def _serialize_data(data: Dict[str, Any], is_user_request: bool) -> str:
+    """Serialize data for the prompt DATA block (user requests send no data)."""
+    return "" if is_user_request else orjson.dumps(data, option=_DATA_JSON_OPTIONS, default=str).decode()
+
+
+def widget_content_hash(data: Dict[str, Any], render_prompt: str, is_user_prompt: bool = False) -> str:
+    """
+    Return a hash of the generation inputs; widgets with the same hash were generated from
+    the same data and prompt. Stored on widget documents so unchanged shares skip generation.
+    """
+    is_user_request = is_user_prompt or not data
+    return _cache_key(is_user_request, render_prompt, _serialize_data(data, is_user_request))
+
+
+def is_error_widget(html: str) -> bool:
+    """Check whether html is one of the error widgets returned instead of generated HTML."""
+    return html.startswith(_ERROR_WIDGET_PREFIX)
+
+
+def _cache_get(key: str) -> Optional[str]:
+    """Return cached widget HTML for key, or None if missing or expired."""
+    entry = _widget_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, html = entry
+    if expires_at < time.monotonic():
+        del _widget_cache[key]
+        return None
+    _widget_cache.move_to_end(key)
+    return html
+
+
+def _cache_set(key: str, html: str) -> None:
+    """Store widget HTML, evicting the least recently used entries over the size limit."""
+    if WIDGET_CACHE_TTL <= 0 or WIDGET_CACHE_SIZE <= 0:
+        return
+    _widget_cache[key] = (time.monotonic() + WIDGET_CACHE_TTL, html)
+    _widget_cache.move_to_end(key)
+    while len(_widget_cache) > WIDGET_CACHE_SIZE:
+        _widget_cache.popitem(last=False)
+
+
+# Claude models in order of preference
+# Note: Haiku models are faster and cheaper, good quality for widgets
+_MODELS_TO_TRY = (
+    "claude-3-5-haiku-20241022",    # Claude 3.5 Haiku (fast, good quality, available)
+    "claude-3-haiku-20240307",      # Claude 3 Haiku (fallback)
+    "claude-3-5-sonnet-20240620",   # Claude 3.5 Sonnet (best quality, if available)
+    "claude-3-sonnet-20240229",     # Claude 3 Sonnet (alternative)
+)
+# Models the API reported as not found; later calls go straight to a working model
+_unavailable_models: set = set()
+
+# Caps concurrent API calls so bursts queue here instead of hitting Anthropic rate limits
+_generation_slots = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
 
-Return the complete widget HTML code now:"""
+
+async def _call_anthropic_api(system_prompt: str, prompt: str) -> str:
+    """Generate a widget with Claude and return the raw response text."""
+    # Skip models that already returned not_found in this process
+    models_to_try = [m for m in _MODELS_TO_TRY if m not in _unavailable_models] or list(_MODELS_TO_TRY)
+    
+    response_text = None
+    last_error = None
+    
+    for model_name in models_to_try:
+        try:
+            # Stream the response so reading can stop as soon as the widget HTML is complete
+            async with _get_client().messages.stream(
+                model=model_name,
+                max_tokens=8192,  # Increased to ensure complete HTML generation
+                system=[
+                    {
+                        "type": "text",
+                        "text": system_prompt,
+                        "cache_control": {"type": "ephemeral"}
+                    }
+                ],
+                messages=[
+                    {"role": "user", "content": prompt}
+                ]
+            ) as stream:
+                response_text = await _read_widget_stream(stream.text_stream)
+            # Success! Break out of loop
+            break
+        except Exception as e:
+            last_error = e
+            # If it's a 404/not_found error, try next model
+            if "404" in str(e) or "not_found" in str(e) or "not_found_error" in str(e):
+                _unavailable_models.add(model_name)
+                continue
             else:
-                # Normal generation mode
-                prompt = f"""Generate a complete, production-ready widget based on the following data and rendering instructions.
+                # For other errors, re-raise immediately
+                raise
+    
+    # If we tried all models and none worked
+    if response_text is None:
+        raise Exception(f"None of the available models worked. Last error: {last_error}")
+    
+    return response_text
 
-DATA TO RENDER:
-{json.dumps(data, indent=2)}
 
-RENDERING INSTRUCTIONS:
-{render_prompt}
+# Error widgets returned in place of generated HTML
+_ERROR_WIDGET_PREFIX = '\n        <div class="widget-error"'
+_CONFIG_ERROR_HTML = """
+        <div class="widget-error" style="padding: 20px; color: #d32f2f; background: #ffebee; border-radius: 8px;">
+            <h3>⚠️ Configuration Error</h3>
+            <p>ANTHROPIC_API_KEY is not set. Please add it to your .env file.</p>
+            <p>Get your API key from <a href="https://console.anthropic.com" target="_blank">console.anthropic.com</a></p>
+        </div>
+        """
+_GENERATION_ERROR_TEMPLATE = """
+        <div class="widget-error" style="padding: 20px; color: #d32f2f; background: #ffebee; border-radius: 8px;">
+            <h3>⚠️ Generation Error</h3>
+            <p>Failed to generate widget: {}</p>
+            <p>Please check your API key and network connection.</p>
+        </div>
+        """
 
-REQUIREMENTS:
-- The widget should be visually appealing and match the rendering instructions
-- Use modern CSS (flexbox/grid, responsive design)
-- Ensure the widget is self-contained (all styles inline or in a <style> tag)
-- Make it responsive and accessible
-- Use semantic HTML
-- The widget should be ready to inject into a dashboard grid
-- CRITICAL: All CSS must be scoped to the widget content only - use class names that won't conflict with dashboard styles
-- Avoid global styles, body/html selectors, or styles that affect elements outside the widget
-- Use inline styles or scoped <style> tags within the widget HTML
 
-IMPORTANT: 
-- Return COMPLETE, FUNCTIONAL HTML code with ALL content elements (divs, spans, text, etc.)
-- Include the full HTML structure with styles AND the actual content displaying the data
-- Do not include any explanatory text, descriptions, or notes before or after the HTML
-- The HTML must display the actual data values, not just styles
-
-Return the complete widget HTML code now:"""
-
-        # Run the blocking Anthropic API call in a thread pool to avoid blocking the event loop
-        def call_anthropic_api():
-            client = Anthropic(api_key=ANTHROPIC_API_KEY)
-            
-            # Call Claude API - try multiple models in order of preference
-            # Note: Haiku models are faster and cheaper, good quality for widgets
-            models_to_try = [
-                "claude-3-5-haiku-20241022",    # Claude 3.5 Haiku (fast, good quality, available)
-                "claude-3-haiku-20240307",      # Claude 3 Haiku (fallback)
-                "claude-3-5-sonnet-20240620",   # Claude 3.5 Sonnet (best quality, if available)
-                "claude-3-sonnet-20240229",     # Claude 3 Sonnet (alternative)
-            ]
-            
-            message = None
-            last_error = None
-            
-            for model_name in models_to_try:
-                try:
-                    message = client.messages.create(
-                        model=model_name,
-                        max_tokens=8192,  # Increased to ensure complete HTML generation
-                        messages=[
-                            {"role": "user", "content": prompt}
-                        ]
-                    )
-                    # Success! Break out of loop
-                    break
-                except Exception as e:
-                    last_error = e
-                    # If it's a 404/not_found error, try next model
-                    if "404" in str(e) or "not_found" in str(e) or "not_found_error" in str(e):
-                        continue
-                    else:
-                        # For other errors, re-raise immediately
-                        raise
-            
-            # If we tried all models and none worked
-            if message is None:
-                raise Exception(f"None of the available models worked. Last error: {last_error}")
-            
-            return message.content[0].text
-        
-        # Execute the blocking call in a thread pool executor
-        loop = asyncio.get_event_loop()
-        response_text = await loop.run_in_executor(_executor, call_anthropic_api)
-        
-        # Debug: Log response length (can be removed later)
-        # print(f"AI Response length: {len(response_text)}")
-        # print(f"AI Response preview: {response_text[:500]}")
-        
-        # Parse HTML from response - try multiple extraction methods
+async def generate_widget_html(
+    data: Dict[str, Any],
+    render_prompt: str,
+    is_user_prompt: bool = False,
+    use_cache: bool = True
+) -> str:
+    """
+    Generate widget HTML/CSS using Claude 3.5 Sonnet based on data and render prompt.
+    
+    Identical requests are served from an in-process cache instead of calling the API.
+    
+    Args:
+        data: The dataset to render
+        render_prompt: Instructions on how to render the data
+        is_user_prompt: True for user prompts (no data provided)
+        use_cache: Return a cached result if available (fresh results are always cached)
         
-        def clean_html(html):
-            """Clean HTML by removing DOCTYPE, html, head, body tags if present, but keep all content."""
-            # Remove DOCTYPE
-            html = re.sub(r'<!DOCTYPE[^>]*>', '', html, flags=re.IGNORECASE)
-            # Remove <html> tags but keep content
-            html = re.sub(r'<html[^>]*>', '', html, flags=re.IGNORECASE)
-            html = re.sub(r'</html>', '', html, flags=re.IGNORECASE)
-            # Extract content from <head> but keep <style> tags (move them out)
-            # First, extract style tags from head
-            head_style_match = re.search(r'<head[^>]*>(.*?)</head>', html, flags=re.IGNORECASE | re.DOTALL)
-            if head_style_match:
-                head_content = head_style_match.group(1)
-                # Extract style tags
-                style_tags = re.findall(r'<style[^>]*>.*?</style>', head_content, flags=re.IGNORECASE | re.DOTALL)
-                # Remove head section
-                html = re.sub(r'<head[^>]*>.*?</head>', '', html, flags=re.IGNORECASE | re.DOTALL)
-                # Add style tags back at the beginning if they exist
-                if style_tags:
-                    html = '\n'.join(style_tags) + '\n' + html
-            # Remove <body> tags but keep content
-            html = re.sub(r'<body[^>]*>', '', html, flags=re.IGNORECASE)
-            html = re.sub(r'</body>', '', html, flags=re.IGNORECASE)
-            # Remove meta tags (we don't need them in widgets)
-            html = re.sub(r'<meta[^>]*>', '', html, flags=re.IGNORECASE)
-            html = re.sub(r'<title[^>]*>.*?</title>', '', html, flags=re.IGNORECASE | re.DOTALL)
-            return html.strip()
+    Returns:
+        HTML string for the widget (with embedded CSS in <style> tag)
+    """
+    # Check if API key is configured
+    if not ANTHROPIC_API_KEY:
+        return _CONFIG_ERROR_HTML
+    
+    try:
+        is_user_request = is_user_prompt or not data
+        # Serialize the data once: it is both hashed for the cache key and sent in the prompt
+        data_json = _serialize_data(data, is_user_request)
         
-        # Method 1: Extract from markdown code blocks (```html ... ```)
-        markdown_match = re.search(r'```html\s*(.*?)\s*```', response_text, re.DOTALL | re.IGNORECASE)
-        if markdown_match:
-            widget_html = markdown_match.group(1).strip()
-            # Remove any remaining explanatory text at the end (but be less aggressive)
-            # Only split if there's a clear break (double newline or "Here's", etc.)
-            split_match = re.search(r'\n\n\s*(?:Here\'s|This widget|The widget|The design|This|These)', widget_html, re.IGNORECASE)
-            if split_match:
-                widget_html = widget_html[:split_match.start()].strip()
-            return clean_html(widget_html)
+        cache_key = _cache_key(is_user_request, render_prompt, data_json)
+        if use_cache:
+            cached_html = _cache_get(cache_key)
+            if cached_html is not None:
+                return cached_html
         
-        # Method 2: Extract content between <html> tags
-        html_match = re.search(r'<html[^>]*>(.*?)</html>', response_text, re.DOTALL | re.IGNORECASE)
-        if html_match:
-            widget_html = html_match.group(1).strip()
-            # Remove any explanatory text
-            widget_html = re.split(r'(?:Here\'s|This widget|The widget|The design)', widget_html, flags=re.IGNORECASE)[0].strip()
-            return clean_html(widget_html)
+        # Static instructions go in a cacheable system block, only the request varies per call
+        has_style_preservation = "CRITICAL STYLE PRESERVATION" in render_prompt or "CURRENT WIDGET STYLES" in render_prompt
+        system_prompt = _SYSTEM_PROMPTS[(is_user_request, has_style_preservation)]
         
-        # Method 3: Extract from any code block (``` ... ```)
-        code_block_match = re.search(r'```[a-z]*\s*(.*?)\s*```', response_text, re.DOTALL)
-        if code_block_match:
-            widget_html = code_block_match.group(1).strip()
-            # Remove explanatory text
-            widget_html = re.split(r'(?:Here\'s|This widget|The widget|The design)', widget_html, flags=re.IGNORECASE)[0].strip()
-            # Check if it looks like HTML
-            if '<' in widget_html and ('div' in widget_html.lower() or 'style' in widget_html.lower()):
-                return clean_html(widget_html)
+        if is_user_request:
+            # User prompt - direct request to AI, no data provided
+            prompt = _USER_REQUEST_HEADER + render_prompt + _PROMPT_FOOTER
+        else:
+            # App prompt - with provided data
+            prompt = _DATA_HEADER + data_json + _INSTRUCTIONS_HEADER + render_prompt + _PROMPT_FOOTER
+
+        if _generation_slots.locked():
+            logger.warning("All %d widget generation slots busy, request is waiting", MAX_CONCURRENT_GENERATIONS)
+        async with _generation_slots:
+            response_text = await _call_anthropic_api(system_prompt, prompt)
         
-        # Method 4: Try to find HTML content in the response
-        # Look for HTML tags and extract everything between first < and last >
-        html_content_match = re.search(r'(<[^>]+>.*?</[^>]+>)', response_text, re.DOTALL)
-        if html_content_match:
-            widget_html = html_content_match.group(1).strip()
-            # Remove any trailing explanatory text
-            lines = widget_html.split('\n')
-            # Find the last line that looks like HTML (contains tags)
-            last_html_line = 0
-            for i, line in enumerate(lines):
-                if '<' in line and '>' in line and not line.strip().startswith('-'):
-                    last_html_line = i
-            
-            widget_html = '\n'.join(lines[:last_html_line + 1]).strip()
-            return widget_html
+        widget_html = _extract_widget_html(response_text)
+        _cache_set(cache_key, widget_html)
+        return widget_html
+    
+    except Exception as e:
+        # Return error widget; the message is escaped since it is rendered unescaped in the page
+        return _GENERATION_ERROR_TEMPLATE.format(escape(str(e)))
+
+
+# Precompiled patterns for HTML extraction and cleanup
+# Document-level wrappers stripped from generated widgets in a single pass;
+# the head alternative captures its content so <style> tags can be kept
+_RE_DOCUMENT_WRAPPERS = re.compile(
+    r'<head[^>]*>(.*?)</head>'
+    r'|<!DOCTYPE[^>]*>|<html[^>]*>|</html>|<body[^>]*>|</body>|<meta[^>]*>'
+    r'|<title[^>]*>.*?</title>',
+    re.IGNORECASE | re.DOTALL
+)
+_RE_STYLE = re.compile(r'<style[^>]*>.*?</style>', re.IGNORECASE | re.DOTALL)
+
+_RE_MARKDOWN_HTML_OPEN = re.compile(r'```html', re.IGNORECASE)
+_RE_MARKDOWN_HTML = re.compile(r'```html\s*(.*?)\s*```', re.DOTALL | re.IGNORECASE)
+_RE_HTML_DOCUMENT = re.compile(r'<html[^>]*>(.*?)</html>', re.DOTALL | re.IGNORECASE)
+_RE_CODE_BLOCK = re.compile(r'```[a-z]*\s*(.*?)\s*```', re.DOTALL)
+_RE_HTML_CONTENT = re.compile(r'(<[^>]+>.*?</[^>]+>)', re.DOTALL)
+
+# Markers of explanatory text following the HTML
+_RE_SPLIT_HINT = re.compile(r'\n\n\s*(?:Here\'s|This widget|The widget|The design|This|These)', re.IGNORECASE)
+_RE_EXPLANATION = re.compile(r'(?:Here\'s|This widget|The widget|The design)', re.IGNORECASE)
+_RE_HTML_END_PATTERNS = (
+    re.compile(r'(?:Here\'s|This widget|The widget|The design|This|These)', re.IGNORECASE | re.MULTILINE),
+    re.compile(r'\n\n(?:This|These|The|Here)', re.IGNORECASE | re.MULTILINE),
+)
+
+# Tag prefixes that mark a line as part of the widget in the fallback extraction
+_HTMLY_TAGS = ('<div', '</div', '<style', '</style', '<span', '<p', '<h')
+
+
+def _clean_html(html: str) -> str:
+    """Clean HTML by removing DOCTYPE, html, head, body tags if present, but keep all content."""
+    style_tags = []
+
+    def strip_wrapper(match: "re.Match[str]") -> str:
+        head_content = match.group(1)
+        if head_content is not None:
+            # Keep <style> tags from <head>, drop the rest of it
+            style_tags.extend(_RE_STYLE.findall(head_content))
+        return ''
+
+    html = _RE_DOCUMENT_WRAPPERS.sub(strip_wrapper, html)
+    # Add head style tags back at the beginning if they exist
+    if style_tags:
+        html = '\n'.join(style_tags) + '\n' + html
+    return html.strip()
+
+
+async def _read_widget_stream(text_stream: AsyncIterable[str]) -> str:
+    """
+    Collect streamed response text.
+    Stops reading once a complete ```html block has arrived, so the explanation
+    the model tends to add after it is not waited for.
+    """
+    response_text = ""
+    fence_start = -1
+    async for text in text_stream:
+        # Markers can straddle chunk boundaries, so rescan the last few characters
+        scan_from = max(len(response_text) - 6, 0)
+        response_text += text
+        if fence_start < 0:
+            fence_match = _RE_MARKDOWN_HTML_OPEN.search(response_text, scan_from)
+            if not fence_match:
+                continue
+            fence_start = fence_match.end()
+        if response_text.find('```', max(scan_from, fence_start)) >= 0:
+            break
+    return response_text
+
+
+def _extract_group(response_text: str, match: "re.Match[str]", stop_pattern: "re.Pattern[str]") -> str:
+    """
+    Return the match's first group cut at the first stop_pattern match.
+    
+    The stop marker is searched within the group's span of the original text,
+    so the response is copied once and then handed to _clean_html (which strips).
+    """
+    start, end = match.span(1)
+    stop = stop_pattern.search(response_text, start, end)
+    return response_text[start:stop.start() if stop else end]
+
+
+def _extract_widget_html(response_text: str) -> str:
+    """Extract widget HTML from the raw model response."""
+    # Parse HTML from response - try multiple extraction methods
+    # Cheap substring checks decide which regex scans can possibly match
+    has_fence = '```' in response_text
+    has_closing_tag = '</' in response_text
+    
+    # Method 1: Extract from markdown code blocks (```html ... ```)
+    markdown_match = _RE_MARKDOWN_HTML.search(response_text) if has_fence else None
+    if markdown_match:
+        # Remove any remaining explanatory text at the end (but be less aggressive)
+        # Only split if there's a clear break (double newline or "Here's", etc.)
+        return _clean_html(_extract_group(response_text, markdown_match, _RE_SPLIT_HINT))
+    
+    # Method 2: Extract content between <html> tags
+    html_match = _RE_HTML_DOCUMENT.search(response_text) if has_closing_tag and '</html>' in response_text.lower() else None
+    if html_match:
+        # Remove any explanatory text
+        return _clean_html(_extract_group(response_text, html_match, _RE_EXPLANATION))
+    
+    # Method 3: Extract from any code block (``` ... ```)
+    code_block_match = _RE_CODE_BLOCK.search(response_text) if has_fence else None
+    if code_block_match:
+        # Remove explanatory text
+        widget_html = _extract_group(response_text, code_block_match, _RE_EXPLANATION)
+        # Check if it looks like HTML
+        if '<' in widget_html:
+            lowered = widget_html.lower()
+            if 'div' in lowered or 'style' in lowered:
+                return _clean_html(widget_html)
+    
+    # Method 4: Try to find HTML content in the response
+    # Look for HTML tags and extract everything between first < and last >
+    html_content_match = _RE_HTML_CONTENT.search(response_text) if has_closing_tag else None
+    if html_content_match:
+        widget_html = html_content_match.group(1).strip()
+        # Remove any trailing explanatory text
+        lines = widget_html.split('\n')
+        # Find the last line that looks like HTML (contains tags), scanning from the end
+        last_html_line = next(
+            (i for i in range(len(lines) - 1, -1, -1)
+             if '<' in lines[i] and '>' in lines[i] and not lines[i].lstrip().startswith('-')),
+            0
+        )
         
-        # Method 5: If response looks like HTML (starts with <), extract it
-        if response_text.strip().startswith('<'):
-            # Find where HTML ends (before explanatory text)
-            # Look for common patterns that indicate end of HTML
-            html_end_patterns = [
-                r'(?:Here\'s|This widget|The widget|The design|This|These)',
-                r'\n\n(?:This|These|The|Here)',
-            ]
-            
-            widget_html = response_text.strip()
-            for pattern in html_end_patterns:
-                match = re.search(pattern, widget_html, re.IGNORECASE | re.MULTILINE)
-                if match:
-                    widget_html = widget_html[:match.start()].strip()
-                    break
-            
-            # Ensure it ends with a closing tag
-            if widget_html and widget_html.rstrip().endswith('>'):
-                return clean_html(widget_html)
+        widget_html = '\n'.join(lines[:last_html_line + 1]).strip()
+        return widget_html
+    
+    # Method 5: If response looks like HTML (starts with <), extract it
+    if response_text.strip().startswith('<'):
+        # Find where HTML ends (before explanatory text)
+        # Look for common patterns that indicate end of HTML
+        widget_html = response_text.strip()
+        for pattern in _RE_HTML_END_PATTERNS:
+            match = pattern.search(widget_html)
+            if match:
+                widget_html = widget_html[:match.start()].strip()
+                break
         
-        # Fallback: Return as-is if it contains HTML-like content
-        if '<' in response_text and '>' in response_text:
-            # Try to extract just the HTML portion
-            # Remove lines that look like explanations (don't contain HTML tags)
-            lines = response_text.split('\n')
-            html_lines = []
-            in_html = False
-            for line in lines:
-                if '<' in line:
-                    in_html = True
+        # Ensure it ends with a closing tag
+        if widget_html and widget_html.rstrip().endswith('>'):
+            return _clean_html(widget_html)
+    
+    # Fallback: Return as-is if it contains HTML-like content
+    if '<' in response_text and '>' in response_text:
+        # Try to extract just the HTML portion
+        # Remove lines that look like explanations (don't contain HTML tags)
+        lines = response_text.split('\n')
+        html_lines = []
+        in_html = False
+        for line in lines:
+            if '<' in line:
+                in_html = True
+                html_lines.append(line)
+            elif in_html:
+                if '>' in line or line.strip().startswith('<!--') or not line.strip():
                     html_lines.append(line)
-                elif in_html:
-                    if '>' in line or line.strip().startswith('<!--') or not line.strip():
+                else:
+                    # Probably hit explanatory text, but continue if it looks like HTML
+                    lowered = line.lower()
+                    if any(tag in lowered for tag in _HTMLY_TAGS):
                         html_lines.append(line)
                     else:
-                        # Probably hit explanatory text, but continue if it looks like HTML
-                        if any(tag in line.lower() for tag in ['<div', '</div', '<style', '</style', '<span', '<p', '<h']):
-                            html_lines.append(line)
-                        else:
-                            break
-            
-            if html_lines:
-                return clean_html('\n'.join(html_lines).strip())
+                        break
         
-        # Last resort: wrap in a div
-        return f"""
-        <div style="padding: 20px; font-family: system-ui;">
-            {response_text}
-        </div>
-        """
+        if html_lines:
+            return _clean_html('\n'.join(html_lines).strip())
     
-    except Exception as e:
-        # Return error widget
-        return f"""
-        <div class="widget-error" style="padding: 20px; color: #d32f2f; background: #ffebee; border-radius: 8px;">
-            <h3>⚠️ Generation Error</h3>
-            <p>Failed to generate widget: {str(e)}</p>
-            <p>Please check your API key and network connection.</p>
-        </div>
-        """
-
+    # Last resort: wrap in a div
+    return f"""
+    <div style="padding: 20px; font-family: system-ui;">
+        {response_text}
+    </div>
+    """
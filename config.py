@@ -3,6 +3,9 @@ Configuration management using Pydantic Settings (FastAPI best practice).
 Automatically loads from environment variables with validation.
 """
 
+import os
+from functools import lru_cache, cached_property
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Literal
 
@@ -16,15 +19,21 @@ class Settings(BaseSettings):
     # MongoDB configuration
     mongodb_uri: str = "mongodb://localhost:27017/"
     mongodb_db_name: str = "ai_dashboard"
+    mongodb_max_pool_size: int = 100  # Upper bound on concurrent MongoDB connections
+    mongodb_warm_connections: int = 5  # Connections opened at startup and kept in the pool
     
     # Security
     registration_token: str = "demo_registration_token_123"
     
     # AI Configuration
     anthropic_api_key: str = ""
+    max_concurrent_generations: int = Field(5, ge=1)  # Widget generations allowed in flight at once; extra requests wait
     
     # Widget Configuration
     widget_refresh_interval: int = 30000
+    dashboard_cache_ttl: int = 60  # Seconds to serve the rendered dashboard page from memory (0 disables)
+    widget_cache_ttl: int = 3600  # Seconds to reuse generated HTML for identical requests (0 disables)
+    widget_cache_size: int = 256
     
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -33,29 +42,39 @@ class Settings(BaseSettings):
         extra="ignore"  # Ignore extra env vars
     )
     
-    @property
+    @cached_property
     def is_production(self) -> bool:
-        """Check if running in production."""
+        """Check if running in production (evaluated once per Settings instance)."""
         # Auto-detect: Heroku sets DYNO env var
-        import os
         if self.environment == "production":
             return True
         return bool(os.getenv("DYNO"))
     
-    @property
+    @cached_property
     def mongodb_uri_normalized(self) -> str:
-        """Get normalized MongoDB URI."""
+        """Get normalized MongoDB URI (computed once per Settings instance)."""
         return self.mongodb_uri.rstrip("/")
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Return the single Settings instance (environment and .env are read once)."""
+    return Settings()
+
+
 # Global settings instance
-settings = Settings()
+settings = get_settings()
 
 # Backward compatibility exports (for existing code)
 ENVIRONMENT = settings.environment
 IS_PRODUCTION = settings.is_production
 MONGODB_URI = settings.mongodb_uri_normalized
 MONGODB_DB_NAME = settings.mongodb_db_name
+MONGODB_MAX_POOL_SIZE = settings.mongodb_max_pool_size
+MONGODB_WARM_CONNECTIONS = settings.mongodb_warm_connections
 REGISTRATION_TOKEN = settings.registration_token
 ANTHROPIC_API_KEY = settings.anthropic_api_key
+MAX_CONCURRENT_GENERATIONS = settings.max_concurrent_generations
 WIDGET_REFRESH_INTERVAL = settings.widget_refresh_interval
+WIDGET_CACHE_TTL = settings.widget_cache_ttl
+WIDGET_CACHE_SIZE = settings.widget_cache_size
@@ -1,7 +1,14 @@
-from pymongo import MongoClient
-from config import MONGODB_URI, MONGODB_DB_NAME, IS_PRODUCTION
+from pymongo import AsyncMongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from config import MONGODB_URI, MONGODB_DB_NAME, MONGODB_MAX_POOL_SIZE, MONGODB_WARM_CONNECTIONS, IS_PRODUCTION
+from functools import lru_cache
+import asyncio
 import re
 import os
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Extract database name from URI if present, otherwise use config
 db_name = MONGODB_DB_NAME
@@ -13,35 +20,37 @@ if match:
 
 # MongoDB connection configuration
 # Production (MongoDB Atlas) vs Local development
-def create_mongodb_client():
+def mongodb_client_options() -> dict:
     """
-    Create MongoDB client with appropriate configuration based on environment.
+    MongoDB client options based on environment.
     Production (Atlas): Uses SSL/TLS with certificate verification
     Local: No SSL/TLS required
     """
+    options = {
+        "serverSelectionTimeoutMS": 10000,
+        "connectTimeoutMS": 10000,
+        "socketTimeoutMS": 20000,
+        "retryWrites": True,
+        "w": "majority",
+        "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": min(MONGODB_WARM_CONNECTIONS, MONGODB_MAX_POOL_SIZE),
+    }
     if IS_PRODUCTION or MONGODB_URI.startswith('mongodb+srv://'):
         # Production: MongoDB Atlas requires SSL/TLS
         import certifi
-        return MongoClient(
-            MONGODB_URI,
-            serverSelectionTimeoutMS=10000,
-            connectTimeoutMS=10000,
-            socketTimeoutMS=20000,
-            retryWrites=True,
-            w='majority',
-            tlsCAFile=certifi.where(),  # Use certifi's CA bundle for certificate verification
-            tlsAllowInvalidCertificates=False,  # Verify certificates properly
-        )
-    else:
-        # Local development: No SSL/TLS needed
-        return MongoClient(
-            MONGODB_URI,
-            serverSelectionTimeoutMS=10000,
-            connectTimeoutMS=10000,
-            socketTimeoutMS=20000,
-            retryWrites=True,
-            w='majority',
-        )
+        options["tlsCAFile"] = certifi.where()  # Use certifi's CA bundle for certificate verification
+        options["tlsAllowInvalidCertificates"] = False  # Verify certificates properly
+    return options
+
+
+@lru_cache(maxsize=1)
+def create_mongodb_client():
+    """
+    Create the asyncio MongoDB client (one per process, reused on re-import).
+    Operations are awaited directly on the event loop, no thread pool involved.
+    """
+    return AsyncMongoClient(MONGODB_URI, **mongodb_client_options())
+
 
 client = create_mongodb_client()
 
@@ -50,4 +59,36 @@ db = client[db_name]
 # Collections
 apps_collection = db["apps"]
 widgets_collection = db["widgets"]
+# Widgets read as undecoded BSON, for endpoints that only pass generated_html through
+raw_widgets_collection = widgets_collection.with_options(
+    codec_options=CodecOptions(document_class=RawBSONDocument)
+)
 
+
+async def init_db():
+    """
+    Create indexes for the hot lookup fields.
+    Idempotent; failures are logged so the app can still start without the database.
+    """
+    try:
+        # verify_integration_token
+        await apps_collection.create_index("integration_token", unique=True)
+        # Dashboard app list (sorted by registration date)
+        await apps_collection.create_index([("registration_date", 1)])
+        # get_app_widget_by_app_id, app widget refresh/update by app_id and the dashboard $lookup
+        await widgets_collection.create_index([("app_id", 1), ("user_created", 1)])
+        # Dashboard user widgets (newest first), sort served by the index
+        await widgets_collection.create_index([("user_created", 1), ("created_at", -1)])
+    except Exception as e:
+        logger.warning("Could not create MongoDB indexes: %s", e)
+
+
+async def warm_up_pool():
+    """
+    Open the warm pool connections (TCP/TLS handshakes) before serving requests.
+    Concurrent pings each check out their own connection; failures are logged.
+    """
+    try:
+        await asyncio.gather(*(client.admin.command('ping') for _ in range(MONGODB_WARM_CONNECTIONS)))
+    except Exception as e:
+        logger.warning("Could not warm up MongoDB connection pool: %s", e)
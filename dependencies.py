@@ -2,41 +2,70 @@
 FastAPI dependencies for dependency injection (best practice).
 """
 
+import logging
 from fastapi import Depends, HTTPException, status
-from typing import Annotated
+from typing import Annotated, Optional
 from bson import ObjectId
-from database import apps_collection, widgets_collection
+from database import client, apps_collection, widgets_collection
 from config import settings
-from models import RegisterRequest, ShareDataRequest
-import asyncio
+from models import RegisterRequest, ShareDataRequest, RegisterAndShareRequest
 
+logger = logging.getLogger(__name__)
 
-def verify_registration_token(request: RegisterRequest) -> RegisterRequest:
+
+def _check_registration_token(registration_token: str) -> None:
+    """Raise 401 unless registration_token matches the configured token."""
+    if registration_token != settings.registration_token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid registration token"
+        )
+
+
+async def verify_registration_token(request: RegisterRequest) -> RegisterRequest:
     """
     Verify registration token from request.
     Used as a dependency for registration endpoints.
     Returns the request if token is valid.
+    Async (though it never awaits) so FastAPI runs it on the event loop instead of the threadpool.
     """
-    if request.registration_token != settings.registration_token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid registration token"
-        )
+    _check_registration_token(request.registration_token)
     return request
 
 
+async def verify_register_and_share_token(request: RegisterAndShareRequest) -> RegisterAndShareRequest:
+    """
+    Verify registration token of a combined register-and-share request.
+    Returns the request if token is valid.
+    """
+    _check_registration_token(request.registration_token)
+    return request
+
+
+async def check_database_connection() -> Optional[str]:
+    """
+    Ping MongoDB for the health check.
+    Returns None if the database answered, otherwise the error message.
+    """
+    try:
+        await client.admin.command('ping')
+        return None
+    except Exception as e:
+        logger.error("Health check failed: %s", e)
+        return str(e)
+
+
 async def verify_integration_token(request: ShareDataRequest) -> dict:
     """
     Verify integration token from request and return app document.
     Used as a dependency for app widget endpoints.
+    Only `_id` and `app_name` are loaded from the app document.
     """
-    loop = asyncio.get_event_loop()
-    
-    def find_app():
-        return apps_collection.find_one({"integration_token": request.integration_token})
-    
     try:
-        app = await loop.run_in_executor(None, find_app)
+        app = await apps_collection.find_one(
+            {"integration_token": request.integration_token},
+            {"app_name": 1}
+        )
         if not app:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -57,18 +86,15 @@ async def get_widget_by_id(widget_id: str, user_created: bool = True) -> dict:
     Get widget by ID.
     Used as a dependency for widget operations.
     """
-    loop = asyncio.get_event_loop()
-    
-    def find_widget():
-        try:
-            query = {"_id": ObjectId(widget_id), "user_created": user_created}
-            return widgets_collection.find_one(query)
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
+    # Malformed IDs can never match, so skip the database round trip
+    if not ObjectId.is_valid(widget_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Widget not found"
+        )
     try:
-        widget = await loop.run_in_executor(None, find_widget)
+        query = {"_id": ObjectId(widget_id), "user_created": user_created}
+        widget = await widgets_collection.find_one(query)
         if not widget:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -78,6 +104,7 @@ async def get_widget_by_id(widget_id: str, user_created: bool = True) -> dict:
     except HTTPException:
         raise
     except Exception as e:
+        logger.exception("Error finding widget")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Database error: {str(e)}"
@@ -89,20 +116,8 @@ async def get_app_widget_by_app_id(app_id: str) -> dict:
     Get app widget by app_id.
     Used as a dependency for app widget operations.
     """
-    loop = asyncio.get_event_loop()
-    
-    def find_widget():
-        try:
-            return widgets_collection.find_one({
-                "app_id": app_id,
-                "user_created": {"$ne": True}
-            })
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
     try:
-        widget = await loop.run_in_executor(None, find_widget)
+        widget = await widgets_collection.find_one({"app_id": app_id, "user_created": {"$ne": True}})
         if not widget:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -112,8 +127,8 @@ async def get_app_widget_by_app_id(app_id: str) -> dict:
     except HTTPException:
         raise
     except Exception as e:
+        logger.exception("Error finding widget")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Database error: {str(e)}"
         )
-
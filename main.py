@@ -1,24 +1,36 @@
 from fastapi import FastAPI, HTTPException, Depends, status
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
+import re
+import asyncio
 import secrets
 import logging
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Annotated
+from bson import ObjectId
+from pymongo import UpdateOne
+from typing import Annotated, List, Optional, Tuple
 
 from models import (
     RegisterRequest, RegisterResponse, ShareDataRequest, ShareDataResponse,
+    RegisterAndShareRequest, RegisterAndShareResponse, BatchShareRequest,
     CreateUserWidgetRequest, CreateUserWidgetResponse,
     EditUserWidgetRequest, EditUserWidgetResponse,
     DeleteUserWidgetRequest, DeleteUserWidgetResponse,
     RefreshAppWidgetResponse, DeleteAppWidgetResponse
 )
-from database import apps_collection, widgets_collection
+from database import (
+    client, apps_collection, widgets_collection, raw_widgets_collection,
+    init_db, warm_up_pool
+)
 from config import settings
-from ai_generator import generate_widget_html
+from ai_generator import generate_widget_html, close_anthropic_client, widget_content_hash, is_error_widget
 from dependencies import (
+    check_database_connection,
     verify_registration_token,
+    verify_register_and_share_token,
     verify_integration_token,
     get_widget_by_id,
     get_app_widget_by_app_id
@@ -31,13 +43,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Prepare the database (indexes, warm connections) before serving requests and release clients on shutdown."""
+    await asyncio.gather(init_db(), warm_up_pool())
+    yield
+    await asyncio.gather(close_anthropic_client(), client.close())
+
+
 # Initialize FastAPI app with metadata
 app = FastAPI(
     title="AI Dashboard",
     description="AI-powered dashboard for aggregating 3rd party app widgets",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS middleware (best practice for APIs)
@@ -50,43 +73,195 @@ app.add_middleware(
 )
 
 # Jinja2 templates
-templates = Environment(loader=FileSystemLoader("templates"))
+# Autoescaped (widget HTML is marked |safe in the template), rendered asynchronously,
+# compiled templates cached on disk and only re-checked for changes outside production
+templates = Environment(
+    loader=FileSystemLoader("templates"),
+    autoescape=select_autoescape(["html"]),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=not settings.is_production,
+    enable_async=True
+)
+# Template nodes joined into each streamed chunk
+TEMPLATE_STREAM_BUFFER = 5
+
+# <style> tags in stored widget HTML (used to preserve styles on refresh)
+_STYLE_OPEN_RE = re.compile(r'<style[^>]*>', re.IGNORECASE)
+_STYLE_CLOSE_RE = re.compile(r'</style>', re.IGNORECASE)
+
+
+def extract_style_blocks(html: str) -> list:
+    """
+    Return the contents of each <style>...</style> block in html.
+    Scans forward once, alternating between the next opening and closing tag,
+    so unclosed <style> tags cannot make the scan rescan the rest of the document.
+    """
+    blocks = []
+    pos = 0
+    while True:
+        opening = _STYLE_OPEN_RE.search(html, pos)
+        if not opening:
+            return blocks
+        closing = _STYLE_CLOSE_RE.search(html, opening.end())
+        if not closing:
+            return blocks
+        blocks.append(html[opening.end():closing.start()])
+        pos = closing.end()
+
+# Appended to a widget's prompt on refresh so the regenerated widget keeps its look
+_STYLE_PRESERVATION_REQUIREMENTS = """
+
+CRITICAL STYLE PRESERVATION REQUIREMENTS:
+You MUST preserve the EXACT visual appearance and styling of the current widget.
+- Keep the SAME colors, fonts, spacing, borders, shadows, and all visual properties
+- Use the SAME CSS classes and styling patterns
+- Maintain the SAME layout structure and component arrangement
+- Preserve the SAME design aesthetic and visual hierarchy
+- DO NOT change colors, sizes, or styling unless absolutely necessary
+"""
+_CURRENT_STYLES_FOOTER = (
+    "```\n"
+    "\nIMPORTANT: Use these exact styles or very similar ones. Match the color scheme, typography, spacing, and visual design.\n"
+)
+
+
+def build_style_preservation_prompt(original_prompt: str, style_blocks: list) -> str:
+    """Append style preservation instructions (and the widget's current CSS) to a prompt."""
+    if not style_blocks:
+        return original_prompt + _STYLE_PRESERVATION_REQUIREMENTS
+    current_styles = "".join(f"{block.strip()}\n" for block in style_blocks)
+    return (
+        f"{original_prompt}{_STYLE_PRESERVATION_REQUIREMENTS}"
+        f"\nCURRENT WIDGET STYLES (preserve these):\n```css\n{current_styles}{_CURRENT_STYLES_FOOTER}"
+    )
+
+
+# Rendered dashboard page, reused until a write endpoint bumps the version or the TTL expires
+# (in-process: the Procfile pins one uvicorn worker on a single web dyno, so every write sees this cache)
+_dashboard_version = 0
+_dashboard_cache: Optional[Tuple[int, float, str]] = None  # (version, expires_at, html)
+
+
+def invalidate_dashboard_cache() -> None:
+    """Mark the cached dashboard page stale; call after any app or widget write."""
+    global _dashboard_version
+    _dashboard_version += 1
+
+
+# Fields of user widgets rendered on the dashboard
+USER_WIDGET_FIELDS = {"widget_name": 1, "render_prompt": 1, "generated_html": 1}
+# Existence checks only need to know a document matched
+EXISTS_ONLY = {"_id": 1}
+
+# Apps sorted by registration date, each joined with its app widget (app_id is stored as a string)
+APP_WIDGETS_PIPELINE = [
+    {"$sort": {"registration_date": 1}},
+    {"$lookup": {
+        "from": widgets_collection.name,
+        "let": {"app_id": {"$toString": "$_id"}},
+        "pipeline": [
+            {"$match": {"$expr": {"$and": [
+                {"$eq": ["$app_id", "$$app_id"]},
+                {"$ne": ["$user_created", True]}
+            ]}}},
+            {"$limit": 1},
+            {"$project": {"_id": 0, "generated_html": 1}}
+        ],
+        "as": "widget"
+    }},
+    {"$project": {"app_name": 1, "widget": 1}}
+]
 
 
 # Health check endpoint (best practice)
 @app.get("/health", tags=["health"])
-async def health_check():
+async def health_check(database_error: Annotated[Optional[str], Depends(check_database_connection)]):
     """
     Health check endpoint for monitoring.
     Returns 200 if the service is healthy.
     """
-    try:
-        # Quick database connectivity check
-        import asyncio
-        loop = asyncio.get_event_loop()
-        def ping_db():
-            from database import client
-            client.admin.command('ping')
-        
-        await loop.run_in_executor(None, ping_db)
-        
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "status": "healthy",
-                "environment": settings.environment,
-                "database": "connected"
-            }
-        )
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return JSONResponse(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            content={
-                "status": "unhealthy",
-                "error": str(e)
-            }
+    if database_error is None:
+        return {
+            "status": "healthy",
+            "environment": settings.environment,
+            "database": "connected"
+        }
+    return ORJSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+            "status": "unhealthy",
+            "error": database_error
+        }
+    )
+
+
+async def _create_app(app_name: str) -> RegisterResponse:
+    """Save a new app with a fresh integration token."""
+    # Generate integration token
+    integration_token = secrets.token_urlsafe(32)
+    
+    # Save app to database
+    app_doc = {
+        "app_name": app_name,
+        "integration_token": integration_token,
+        "registration_date": datetime.utcnow(),
+        "created_at": datetime.utcnow()
+    }
+    result = await apps_collection.insert_one(app_doc)
+    app_id = str(result.inserted_id)
+    
+    invalidate_dashboard_cache()
+    
+    return RegisterResponse(
+        integration_token=integration_token,
+        app_id=app_id
+    )
+
+
+async def _share_app_data(
+    app_id: str,
+    data: dict,
+    render_prompt: str,
+    skip_if_unchanged: bool = True
+) -> ShareDataResponse:
+    """
+    Generate an app's widget from its data and render prompt and save it.
+    With skip_if_unchanged, nothing is generated when the stored widget came from the same data and prompt.
+    """
+    content_hash = widget_content_hash(data, render_prompt)
+    if skip_if_unchanged and await widgets_collection.find_one(
+        {"app_id": app_id, "content_hash": content_hash}, {"_id": 1}
+    ):
+        return ShareDataResponse(
+            success=True,
+            message="Data unchanged, widget is up to date"
         )
+    
+    # Generate widget HTML using AI (now non-blocking)
+    widget_html = await generate_widget_html(data, render_prompt)
+    
+    # Save/update widget in database
+    widget_doc = {
+        "app_id": app_id,
+        "data": data,
+        "render_prompt": render_prompt,
+        "generated_html": widget_html,
+        # Error widgets get no hash so the next share retries generation
+        "content_hash": None if is_error_widget(widget_html) else content_hash,
+        "updated_at": datetime.utcnow()
+    }
+    await widgets_collection.update_one(
+        {"app_id": app_id},
+        {"$set": widget_doc},
+        upsert=True
+    )
+    
+    invalidate_dashboard_cache()
+    
+    return ShareDataResponse(
+        success=True,
+        message="Data shared and widget generated successfully"
+    )
 
 
 @app.post("/register", response_model=RegisterResponse, tags=["apps"])
@@ -98,31 +273,8 @@ async def register_app(
     Requires registration token.
     Returns integration token.
     """
-    import asyncio
-    loop = asyncio.get_event_loop()
-    
     # Token verification handled by dependency
-    
-    # Generate integration token
-    integration_token = secrets.token_urlsafe(32)
-    
-    # Save app to database (run in executor to avoid blocking)
-    def save_app():
-        app_doc = {
-            "app_name": request.app_name,
-            "integration_token": integration_token,
-            "registration_date": datetime.utcnow(),
-            "created_at": datetime.utcnow()
-        }
-        result = apps_collection.insert_one(app_doc)
-        return str(result.inserted_id)
-    
-    app_id = await loop.run_in_executor(None, save_app)
-    
-    return RegisterResponse(
-        integration_token=integration_token,
-        app_id=app_id
-    )
+    return await _create_app(request.app_name)
 
 
 @app.post("/share-data", response_model=ShareDataResponse, tags=["apps"])
@@ -134,37 +286,100 @@ async def share_data(
     Share data and render prompt from 3rd party app.
     Triggers AI generation and caches the result.
     """
-    import asyncio
-    loop = asyncio.get_event_loop()
-    
     # App verification handled by dependency
-    app_id = str(app["_id"])
+    logger.info("Sharing data for app: %s", app.get('app_name', 'Unknown'))
     
-    logger.info(f"Sharing data for app: {app.get('app_name', 'Unknown')}")
+    return await _share_app_data(str(app["_id"]), request.data, request.render_prompt)
+
+
+@app.post("/batch-share", response_model=List[ShareDataResponse], tags=["apps"])
+async def batch_share(request: BatchShareRequest):
+    """
+    Share data for several apps in one request.
+    Tokens are checked with one query, widgets are generated concurrently and saved in one unordered bulk write.
+    Returns one result per item, in request order; items with an invalid token fail individually.
+    """
+    items = request.items
+    tokens = list({item.integration_token for item in items})
+    apps = await apps_collection.find(
+        {"integration_token": {"$in": tokens}}, {"integration_token": 1}
+    ).to_list(None)
+    app_ids = {app["integration_token"]: str(app["_id"]) for app in apps}
+    
+    stored = await widgets_collection.find(
+        {"app_id": {"$in": list(app_ids.values())}}, {"app_id": 1, "content_hash": 1}
+    ).to_list(None) if app_ids else []
+    stored_hashes = {widget["app_id"]: widget.get("content_hash") for widget in stored}
+    
+    # app_id -> (item index, content_hash) of widgets that need generating; the last item for an app wins
+    to_generate = {}
+    results = []
+    for index, item in enumerate(items):
+        app_id = app_ids.get(item.integration_token)
+        if app_id is None:
+            results.append(ShareDataResponse(success=False, message="Invalid integration token"))
+            continue
+        content_hash = widget_content_hash(item.data, item.render_prompt)
+        if stored_hashes.get(app_id) == content_hash:
+            results.append(ShareDataResponse(success=True, message="Data unchanged, widget is up to date"))
+            continue
+        if app_id in to_generate:
+            superseded_index, _ = to_generate[app_id]
+            results[superseded_index] = ShareDataResponse(
+                success=True, message="Data superseded by a later item for the same app"
+            )
+        to_generate[app_id] = (index, content_hash)
+        results.append(ShareDataResponse(success=True, message="Data shared and widget generated successfully"))
+    
+    if to_generate:
+        widget_htmls = await asyncio.gather(*[
+            generate_widget_html(items[index].data, items[index].render_prompt) for index, _ in to_generate.values()
+        ])
+        now = datetime.utcnow()
+        # At most one write per app, so the writes are independent and need not run in order
+        await widgets_collection.bulk_write([
+            UpdateOne(
+                {"app_id": app_id},
+                {"$set": {
+                    "app_id": app_id,
+                    "data": items[index].data,
+                    "render_prompt": items[index].render_prompt,
+                    "generated_html": widget_html,
+                    "content_hash": None if is_error_widget(widget_html) else content_hash,
+                    "updated_at": now
+                }},
+                upsert=True
+            )
+            for (app_id, (index, content_hash)), widget_html in zip(to_generate.items(), widget_htmls)
+        ], ordered=False)
+        invalidate_dashboard_cache()
     
-    # Generate widget HTML using AI (now non-blocking)
-    widget_html = await generate_widget_html(request.data, request.render_prompt)
+    return results
+
+
+@app.post("/register-and-share", response_model=RegisterAndShareResponse, tags=["apps"])
+async def register_and_share(
+    request: Annotated[RegisterAndShareRequest, Depends(verify_register_and_share_token)]
+):
+    """
+    Register a new 3rd party app and share its first data in one request.
+    Requires registration token.
+    Returns integration token for later /share-data calls.
+    """
+    registration = await _create_app(request.app_name)
     
-    # Save/update widget in database (run in executor to avoid blocking)
-    def save_widget():
-        widget_doc = {
-            "app_id": app_id,
-            "data": request.data,
-            "render_prompt": request.render_prompt,
-            "generated_html": widget_html,
-            "updated_at": datetime.utcnow()
-        }
-        widgets_collection.update_one(
-            {"app_id": app_id},
-            {"$set": widget_doc},
-            upsert=True
-        )
+    logger.info("Sharing data for app: %s", request.app_name)
     
-    await loop.run_in_executor(None, save_widget)
+    # A new app has no stored widget to compare against
+    shared = await _share_app_data(
+        registration.app_id, request.data, request.render_prompt, skip_if_unchanged=False
+    )
     
-    return ShareDataResponse(
-        success=True,
-        message="Data shared and widget generated successfully"
+    return RegisterAndShareResponse(
+        integration_token=registration.integration_token,
+        app_id=registration.app_id,
+        success=shared.success,
+        message=shared.message
     )
 
 
@@ -173,53 +388,79 @@ async def dashboard():
     """
     Main dashboard page - renders all widgets in flexbox layout.
     User widgets appear first (newest first), then app widgets.
+    The rendered page is served from memory until a widget or app changes.
     """
-    import asyncio
-    loop = asyncio.get_event_loop()
-    
-    def get_widgets_data():
-        widgets_data = []
-        
+    version = _dashboard_version
+    if (
+        _dashboard_cache is not None
+        and _dashboard_cache[0] == version
+        and _dashboard_cache[1] > time.monotonic()
+    ):
+        return HTMLResponse(content=_dashboard_cache[2])
+    
+    # Only cache the page when both queries succeeded
+    complete = True
+    
+    async def fetch_user_widgets():
+        nonlocal complete
         try:
             # Get user-created widgets (newest first)
             # Use max_time_ms to limit query time
-            user_widgets = list(widgets_collection.find({"user_created": True}).sort("created_at", -1).max_time_ms(2000))
-            for widget in user_widgets:
-                widgets_data.append({
+            # Only the fields the page shows (the data blob is never loaded)
+            user_widgets = await widgets_collection.find(
+                {"user_created": True},
+                USER_WIDGET_FIELDS
+            ).sort("created_at", -1).max_time_ms(2000).to_list(None)
+            return [
+                {
                     "widget_id": str(widget["_id"]),
                     "app_id": None,  # No app ID for user widgets
                     "app_name": widget.get("widget_name", "User Widget"),
                     "is_user_created": True,
                     "prompt": widget.get("render_prompt", ""),
                     "html": widget.get("generated_html", "<div>No data yet</div>")
-                })
+                }
+                for widget in user_widgets
+            ]
         except Exception as e:
-            print(f"Error fetching user widgets: {e}")
+            logger.exception("Error fetching user widgets")
             # Continue with empty list if error
-        
+            complete = False
+            return []
+    
+    async def fetch_app_widgets():
+        nonlocal complete
         try:
             # Get app-registered widgets (sorted by registration date)
             # Use max_time_ms to limit query time
-            apps = list(apps_collection.find().sort("registration_date", 1).max_time_ms(2000))
+            # Each app is joined with its widget server-side (one round trip for all apps)
+            apps_cursor = await apps_collection.aggregate(APP_WIDGETS_PIPELINE, maxTimeMS=2000)
+            apps = await apps_cursor.to_list(None)
+            app_widgets = []
             for app in apps:
-                app_id = str(app["_id"])
-                widget = widgets_collection.find_one({"app_id": app_id, "user_created": {"$ne": True}}, max_time_ms=2000)
+                widget = app["widget"][0] if app.get("widget") else None
                 
-                widgets_data.append({
+                app_widgets.append({
                     "widget_id": None,
-                    "app_id": app_id,
+                    "app_id": str(app["_id"]),
                     "app_name": app.get("app_name", "Unknown"),
                     "is_user_created": False,
                     "html": widget.get("generated_html", "<div>No data yet</div>") if widget else "<div>No data yet</div>"
                 })
+            return app_widgets
         except Exception as e:
-            print(f"Error fetching app widgets: {e}")
-            # Continue with existing widgets if error
-        
-        return widgets_data
+            logger.exception("Error fetching app widgets")
+            # Continue with user widgets only if error
+            complete = False
+            return []
+    
+    async def get_widgets_data():
+        # The two queries are independent, run them concurrently
+        user_widgets, app_widgets = await asyncio.gather(fetch_user_widgets(), fetch_app_widgets())
+        return user_widgets + app_widgets
     
     try:
-        widgets_data = await loop.run_in_executor(None, get_widgets_data)
+        widgets_data = await get_widgets_data()
     except Exception as e:
         # If database connection fails, show error page
         error_html = f"""
@@ -251,13 +492,29 @@ async def dashboard():
         """
         return HTMLResponse(content=error_html, status_code=503)
     
-    # Render template (fast operation, can stay in async context)
+    # Stream the template so the page head is sent while widgets are still rendering
     template = templates.get_template("dashboard.html")
-    html_content = template.render(
-        widgets=widgets_data,
-        refresh_interval=settings.widget_refresh_interval
-    )
-    return HTMLResponse(content=html_content)
+    
+    async def send_page():
+        global _dashboard_cache
+        chunks = []
+        buffered = 0
+        async for chunk in template.generate_async(
+            widgets=widgets_data,
+            refresh_interval=settings.widget_refresh_interval
+        ):
+            chunks.append(chunk)
+            buffered += 1
+            if buffered == TEMPLATE_STREAM_BUFFER:
+                yield "".join(chunks[-buffered:])
+                buffered = 0
+        if buffered:
+            yield "".join(chunks[-buffered:])
+        if complete and settings.dashboard_cache_ttl > 0:
+            # Stored under the version read before querying, so a write during rendering still invalidates it
+            _dashboard_cache = (version, time.monotonic() + settings.dashboard_cache_ttl, "".join(chunks))
+    
+    return StreamingResponse(send_page(), media_type="text/html")
 
 
 @app.get("/widget/{app_id}/refresh")
@@ -265,7 +522,7 @@ async def refresh_widget(app_id: str):
     """
     Refresh a specific widget (returns cached HTML, no AI regeneration).
     """
-    widget = widgets_collection.find_one({"app_id": app_id})
+    widget = await raw_widgets_collection.find_one({"app_id": app_id}, {"generated_html": 1})
     
     if not widget:
         raise HTTPException(status_code=404, detail="Widget not found")
@@ -278,42 +535,32 @@ async def create_user_widget(request: CreateUserWidgetRequest):
     """
     Create a user widget from a prompt (no data provided).
     """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
     try:
         # Generate widget HTML using AI (prompt only, no data)
-        widget_html = await generate_widget_html({}, request.prompt, is_user_prompt=True)
+        widget_html = await generate_widget_html({}, request.prompt, is_user_prompt=True, use_cache=False)
     except Exception as e:
-        print(f"Error generating widget HTML: {e}")
+        logger.exception("Error generating widget HTML")
         raise HTTPException(
             status_code=500,
             detail=f"Failed to generate widget: {str(e)}"
         )
     
     # Save user widget to database
-    def save_user_widget():
-        try:
-            widget_doc = {
-                "app_id": None,  # No app ID for user widgets
-                "user_created": True,
-                "widget_name": request.widget_name or "User Widget",
-                "data": {},  # No data for user widgets
-                "render_prompt": request.prompt,
-                "generated_html": widget_html,
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow()
-            }
-            result = widgets_collection.insert_one(widget_doc)
-            return str(result.inserted_id)
-        except Exception as e:
-            print(f"Error saving widget to database: {e}")
-            raise
-    
     try:
-        widget_id = await loop.run_in_executor(None, save_user_widget)
+        widget_doc = {
+            "app_id": None,  # No app ID for user widgets
+            "user_created": True,
+            "widget_name": request.widget_name or "User Widget",
+            "data": {},  # No data for user widgets
+            "render_prompt": request.prompt,
+            "generated_html": widget_html,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+        result = await widgets_collection.insert_one(widget_doc)
+        widget_id = str(result.inserted_id)
     except Exception as e:
+        logger.exception("Error saving widget to database")
         error_msg = str(e)
         if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
             raise HTTPException(
@@ -325,6 +572,8 @@ async def create_user_widget(request: CreateUserWidgetRequest):
             detail=f"Failed to save widget: {error_msg}"
         )
     
+    invalidate_dashboard_cache()
+    
     return CreateUserWidgetResponse(
         success=True,
         widget_id=widget_id,
@@ -337,22 +586,13 @@ async def edit_user_widget(request: EditUserWidgetRequest):
     """
     Edit a user widget's prompt and regenerate it.
     """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
     # Find widget
-    def find_widget():
-        try:
-            from bson import ObjectId
-            return widgets_collection.find_one({"_id": ObjectId(request.widget_id), "user_created": True})
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
     try:
-        widget = await loop.run_in_executor(None, find_widget)
+        widget = await widgets_collection.find_one(
+            {"_id": ObjectId(request.widget_id), "user_created": True}, EXISTS_ONLY
+        )
     except Exception as e:
+        logger.exception("Error finding widget")
         error_msg = str(e)
         if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
             raise HTTPException(
@@ -366,7 +606,7 @@ async def edit_user_widget(request: EditUserWidgetRequest):
     
     try:
         # Regenerate widget HTML with new prompt
-        widget_html = await generate_widget_html({}, request.prompt, is_user_prompt=True)
+        widget_html = await generate_widget_html({}, request.prompt, is_user_prompt=True, use_cache=False)
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -374,26 +614,19 @@ async def edit_user_widget(request: EditUserWidgetRequest):
         )
     
     # Update widget
-    def update_widget():
-        try:
-            from bson import ObjectId
-            widgets_collection.update_one(
-                {"_id": ObjectId(request.widget_id)},
-                {
-                    "$set": {
-                        "render_prompt": request.prompt,
-                        "generated_html": widget_html,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-        except Exception as e:
-            print(f"Error updating widget: {e}")
-            raise
-    
     try:
-        await loop.run_in_executor(None, update_widget)
+        await widgets_collection.update_one(
+            {"_id": ObjectId(request.widget_id)},
+            {
+                "$set": {
+                    "render_prompt": request.prompt,
+                    "generated_html": widget_html,
+                    "updated_at": datetime.utcnow()
+                }
+            }
+        )
     except Exception as e:
+        logger.exception("Error updating widget")
         error_msg = str(e)
         if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
             raise HTTPException(
@@ -402,6 +635,8 @@ async def edit_user_widget(request: EditUserWidgetRequest):
             )
         raise HTTPException(status_code=500, detail=f"Failed to update widget: {error_msg}")
     
+    invalidate_dashboard_cache()
+    
     return EditUserWidgetResponse(
         success=True,
         message="User widget updated successfully"
@@ -413,22 +648,11 @@ async def delete_user_widget(request: DeleteUserWidgetRequest):
     """
     Delete a user widget.
     """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
-    def delete_widget():
-        try:
-            from bson import ObjectId
-            result = widgets_collection.delete_one({"_id": ObjectId(request.widget_id), "user_created": True})
-            return result.deleted_count
-        except Exception as e:
-            print(f"Error deleting widget: {e}")
-            raise
-    
     try:
-        deleted_count = await loop.run_in_executor(None, delete_widget)
+        result = await widgets_collection.delete_one({"_id": ObjectId(request.widget_id), "user_created": True})
+        deleted_count = result.deleted_count
     except Exception as e:
+        logger.exception("Error deleting widget")
         error_msg = str(e)
         if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
             raise HTTPException(
@@ -437,6 +661,8 @@ async def delete_user_widget(request: DeleteUserWidgetRequest):
             )
         raise HTTPException(status_code=500, detail=f"Database error: {error_msg}")
     
+    invalidate_dashboard_cache()
+    
     if deleted_count == 0:
         raise HTTPException(status_code=404, detail="User widget not found")
     
@@ -446,100 +672,91 @@ async def delete_user_widget(request: DeleteUserWidgetRequest):
     )
 
 
-@app.post("/api/user-widgets/{widget_id}/refresh")
-async def refresh_user_widget(widget_id: str):
+def _database_http_error(e: Exception, action: str) -> HTTPException:
+    """Map a MongoDB failure to a 503 (connection problem) or 500 HTTPException."""
+    error_msg = str(e)
+    if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
+        return HTTPException(
+            status_code=503,
+            detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
+        )
+    return HTTPException(status_code=500, detail=f"{action}: {error_msg}")
+
+
+async def _regenerate_widget(
+    widget_filter: dict,
+    update_filter: dict,
+    not_found_detail: str,
+    is_user_prompt: bool,
+    preserve_styles: bool
+) -> str:
     """
-    Refresh a user widget - re-generate with same prompt but keep similar styles.
-    Extracts styles from current HTML and tells AI to reuse them.
+    Regenerate a stored widget from its prompt (and data, for app widgets) and save the new HTML.
+    With preserve_styles the widget's current CSS is added to the prompt so the refresh keeps its look.
+    A refresh always asks the model for new output, so the generation cache is never read here.
     """
-    import asyncio
-    import re
-    
-    loop = asyncio.get_event_loop()
-    
-    def find_widget():
-        try:
-            from bson import ObjectId
-            return widgets_collection.find_one({"_id": ObjectId(widget_id), "user_created": True})
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
     try:
-        widget = await loop.run_in_executor(None, find_widget)
+        widget = await widgets_collection.find_one(widget_filter)
     except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Database error: {error_msg}")
+        logger.exception("Error finding widget")
+        raise _database_http_error(e, "Database error")
     
     if not widget:
-        raise HTTPException(status_code=404, detail="User widget not found")
-    
-    # Extract styles from current HTML
-    current_html = widget.get("generated_html", "")
-    style_tags = re.findall(r'<style[^>]*>(.*?)</style>', current_html, re.DOTALL | re.IGNORECASE)
+        raise HTTPException(status_code=404, detail=not_found_detail)
     
-    # Build prompt that strongly emphasizes preserving styles
-    original_prompt = widget.get("render_prompt", "")
-    
-    style_instruction = "\n\nCRITICAL STYLE PRESERVATION REQUIREMENTS:\n"
-    style_instruction += "You MUST preserve the EXACT visual appearance and styling of the current widget.\n"
-    style_instruction += "- Keep the SAME colors, fonts, spacing, borders, shadows, and all visual properties\n"
-    style_instruction += "- Use the SAME CSS classes and styling patterns\n"
-    style_instruction += "- Maintain the SAME layout structure and component arrangement\n"
-    style_instruction += "- Preserve the SAME design aesthetic and visual hierarchy\n"
-    style_instruction += "- DO NOT change colors, sizes, or styling unless absolutely necessary\n"
-    
-    if style_tags:
-        style_instruction += f"\nCURRENT WIDGET STYLES (preserve these):\n"
-        style_instruction += "```css\n"
-        for style_content in style_tags:
-            style_instruction += style_content.strip() + "\n"
-        style_instruction += "```\n"
-        style_instruction += "\nIMPORTANT: Use these exact styles or very similar ones. Match the color scheme, typography, spacing, and visual design.\n"
-    
-    enhanced_prompt = f"{original_prompt}{style_instruction}"
+    data = {} if is_user_prompt else widget.get("data", {})
+    prompt = widget.get("render_prompt", "")
+    if preserve_styles:
+        prompt = build_style_preservation_prompt(prompt, extract_style_blocks(widget.get("generated_html", "")))
     
     try:
-        # Regenerate with enhanced prompt (keeps styles)
-        widget_html = await generate_widget_html({}, enhanced_prompt, is_user_prompt=True)
+        widget_html = await generate_widget_html(data, prompt, is_user_prompt=is_user_prompt, use_cache=False)
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Failed to generate widget: {str(e)}"
         )
     
-    def update_widget():
-        try:
-            from bson import ObjectId
-            widgets_collection.update_one(
-                {"_id": ObjectId(widget_id)},
-                {
-                    "$set": {
-                        "generated_html": widget_html,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-        except Exception as e:
-            print(f"Error updating widget: {e}")
-            raise
-    
     try:
-        await loop.run_in_executor(None, update_widget)
+        await widgets_collection.update_one(
+            update_filter,
+            {
+                "$set": {
+                    "generated_html": widget_html,
+                    "updated_at": datetime.utcnow()
+                }
+            }
+        )
     except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Failed to update widget: {error_msg}")
+        logger.exception("Error updating widget")
+        raise _database_http_error(e, "Failed to update widget")
     
+    invalidate_dashboard_cache()
+    
+    return widget_html
+
+
+def _user_widget_filters(widget_id: str) -> Tuple[dict, dict]:
+    """
+    (lookup, update) filters for a user widget.
+    Malformed IDs can never match, so they get the same 404 as a missing widget.
+    """
+    if not ObjectId.is_valid(widget_id):
+        raise HTTPException(status_code=404, detail="User widget not found")
+    object_id = ObjectId(widget_id)
+    return {"_id": object_id, "user_created": True}, {"_id": object_id}
+
+
+@app.post("/api/user-widgets/{widget_id}/refresh")
+async def refresh_user_widget(widget_id: str):
+    """
+    Refresh a user widget - re-generate with same prompt but keep similar styles.
+    Extracts styles from current HTML and tells AI to reuse them.
+    """
+    widget_filter, update_filter = _user_widget_filters(widget_id)
+    widget_html = await _regenerate_widget(
+        widget_filter, update_filter, "User widget not found", is_user_prompt=True, preserve_styles=True
+    )
     return {"html": widget_html}
 
 
@@ -548,68 +765,10 @@ async def full_refresh_user_widget(widget_id: str):
     """
     Full refresh a user widget - re-generate with original prompt (new design).
     """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
-    def find_widget():
-        try:
-            from bson import ObjectId
-            return widgets_collection.find_one({"_id": ObjectId(widget_id), "user_created": True})
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
-    try:
-        widget = await loop.run_in_executor(None, find_widget)
-    except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Database error: {error_msg}")
-    
-    if not widget:
-        raise HTTPException(status_code=404, detail="User widget not found")
-    
-    try:
-        # Regenerate with original prompt (full refresh)
-        widget_html = await generate_widget_html({}, widget.get("render_prompt", ""), is_user_prompt=True)
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to generate widget: {str(e)}"
-        )
-    
-    def update_widget():
-        try:
-            from bson import ObjectId
-            widgets_collection.update_one(
-                {"_id": ObjectId(widget_id)},
-                {
-                    "$set": {
-                        "generated_html": widget_html,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-        except Exception as e:
-            print(f"Error updating widget: {e}")
-            raise
-    
-    try:
-        await loop.run_in_executor(None, update_widget)
-    except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Failed to update widget: {error_msg}")
-    
+    widget_filter, update_filter = _user_widget_filters(widget_id)
+    widget_html = await _regenerate_widget(
+        widget_filter, update_filter, "User widget not found", is_user_prompt=True, preserve_styles=False
+    )
     return {"html": widget_html}
 
 
@@ -619,94 +778,10 @@ async def refresh_app_widget(app_id: str):
     Refresh an app widget - re-generate with same data but keep similar styles.
     Extracts styles from current HTML and tells AI to reuse them.
     """
-    import asyncio
-    import re
-    
-    loop = asyncio.get_event_loop()
-    
-    def find_widget():
-        try:
-            from bson import ObjectId
-            return widgets_collection.find_one({"app_id": app_id, "user_created": {"$ne": True}})
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
-    try:
-        widget = await loop.run_in_executor(None, find_widget)
-    except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Database error: {error_msg}")
-    
-    if not widget:
-        raise HTTPException(status_code=404, detail="App widget not found")
-    
-    # Extract styles from current HTML
-    current_html = widget.get("generated_html", "")
-    style_tags = re.findall(r'<style[^>]*>(.*?)</style>', current_html, re.DOTALL | re.IGNORECASE)
-    
-    # Build prompt that strongly emphasizes preserving styles
-    data = widget.get("data", {})
-    original_prompt = widget.get("render_prompt", "")
-    
-    style_instruction = "\n\nCRITICAL STYLE PRESERVATION REQUIREMENTS:\n"
-    style_instruction += "You MUST preserve the EXACT visual appearance and styling of the current widget.\n"
-    style_instruction += "- Keep the SAME colors, fonts, spacing, borders, shadows, and all visual properties\n"
-    style_instruction += "- Use the SAME CSS classes and styling patterns\n"
-    style_instruction += "- Maintain the SAME layout structure and component arrangement\n"
-    style_instruction += "- Preserve the SAME design aesthetic and visual hierarchy\n"
-    style_instruction += "- DO NOT change colors, sizes, or styling unless absolutely necessary\n"
-    
-    if style_tags:
-        style_instruction += f"\nCURRENT WIDGET STYLES (preserve these):\n"
-        style_instruction += "```css\n"
-        for style_content in style_tags:
-            style_instruction += style_content.strip() + "\n"
-        style_instruction += "```\n"
-        style_instruction += "\nIMPORTANT: Use these exact styles or very similar ones. Match the color scheme, typography, spacing, and visual design.\n"
-    
-    enhanced_prompt = f"{original_prompt}{style_instruction}"
-    
-    try:
-        # Regenerate with same data but enhanced prompt
-        widget_html = await generate_widget_html(data, enhanced_prompt, is_user_prompt=False)
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to generate widget: {str(e)}"
-        )
-    
-    def update_widget():
-        try:
-            widgets_collection.update_one(
-                {"app_id": app_id},
-                {
-                    "$set": {
-                        "generated_html": widget_html,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-        except Exception as e:
-            print(f"Error updating widget: {e}")
-            raise
-    
-    try:
-        await loop.run_in_executor(None, update_widget)
-    except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Failed to update widget: {error_msg}")
-    
+    widget_html = await _regenerate_widget(
+        {"app_id": app_id, "user_created": {"$ne": True}}, {"app_id": app_id},
+        "App widget not found", is_user_prompt=False, preserve_styles=True
+    )
     return RefreshAppWidgetResponse(
         success=True,
         html=widget_html,
@@ -720,70 +795,10 @@ async def full_refresh_app_widget(app_id: str):
     Full refresh an app widget - re-generate with original prompt and data.
     This creates a completely new widget design.
     """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
-    def find_widget():
-        try:
-            from bson import ObjectId
-            return widgets_collection.find_one({"app_id": app_id, "user_created": {"$ne": True}})
-        except Exception as e:
-            print(f"Error finding widget: {e}")
-            raise
-    
-    try:
-        widget = await loop.run_in_executor(None, find_widget)
-    except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Database error: {error_msg}")
-    
-    if not widget:
-        raise HTTPException(status_code=404, detail="App widget not found")
-    
-    # Regenerate with original prompt and data
-    data = widget.get("data", {})
-    original_prompt = widget.get("render_prompt", "")
-    
-    try:
-        widget_html = await generate_widget_html(data, original_prompt, is_user_prompt=False)
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to generate widget: {str(e)}"
-        )
-    
-    def update_widget():
-        try:
-            widgets_collection.update_one(
-                {"app_id": app_id},
-                {
-                    "$set": {
-                        "generated_html": widget_html,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-        except Exception as e:
-            print(f"Error updating widget: {e}")
-            raise
-    
-    try:
-        await loop.run_in_executor(None, update_widget)
-    except Exception as e:
-        error_msg = str(e)
-        if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection failed. Please check MongoDB Atlas Network Access settings."
-            )
-        raise HTTPException(status_code=500, detail=f"Failed to update widget: {error_msg}")
-    
+    widget_html = await _regenerate_widget(
+        {"app_id": app_id, "user_created": {"$ne": True}}, {"app_id": app_id},
+        "App widget not found", is_user_prompt=False, preserve_styles=False
+    )
     return RefreshAppWidgetResponse(
         success=True,
         html=widget_html,
@@ -797,29 +812,24 @@ async def delete_app_widget(app_id: str):
     Delete an app widget and unregister the app.
     This removes both the widget and the app registration.
     """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
-    def delete_app_and_widget():
-        try:
-            from bson import ObjectId
-            # Delete widget
-            widget_result = widgets_collection.delete_one({"app_id": app_id})
-            # Delete app
-            app_result = apps_collection.delete_one({"_id": ObjectId(app_id)})
-            
-            if app_result.deleted_count == 0:
-                return False, "App not found"
-            
-            return True, f"App and widget deleted successfully"
-        except Exception as e:
-            print(f"Error deleting app/widget: {e}")
-            raise
+    # Malformed IDs can never match an app; reject them before any delete is started
+    if not ObjectId.is_valid(app_id):
+        raise HTTPException(status_code=404, detail="App not found")
+    app_object_id = ObjectId(app_id)
     
     try:
-        success, message = await loop.run_in_executor(None, delete_app_and_widget)
+        # Delete widget and app concurrently (independent documents, one round trip of latency)
+        _, app_result = await asyncio.gather(
+            widgets_collection.delete_one({"app_id": app_id}),
+            apps_collection.delete_one({"_id": app_object_id})
+        )
+        
+        if app_result.deleted_count == 0:
+            success, message = False, "App not found"
+        else:
+            success, message = True, "App and widget deleted successfully"
     except Exception as e:
+        logger.exception("Error deleting app/widget")
         error_msg = str(e)
         if "SSL handshake" in error_msg or "ServerSelectionTimeout" in error_msg:
             raise HTTPException(
@@ -828,6 +838,8 @@ async def delete_app_widget(app_id: str):
             )
         raise HTTPException(status_code=500, detail=f"Database error: {error_msg}")
     
+    invalidate_dashboard_cache()
+    
     if not success:
         raise HTTPException(status_code=404, detail=message)
     
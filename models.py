@@ -1,66 +1,93 @@
 from datetime import datetime
-from typing import Optional, Dict, Any
-from pydantic import BaseModel
+from typing import Optional, Dict, Any, List
+from pydantic import BaseModel, ConfigDict, Field
 
 
-class RegisterRequest(BaseModel):
+class FrozenModel(BaseModel):
+    """Base for request/response models; instances are immutable once validated."""
+    model_config = ConfigDict(frozen=True)
+
+
+class RegisterRequest(FrozenModel):
     registration_token: str
     app_name: str
 
 
-class RegisterResponse(BaseModel):
+class RegisterResponse(FrozenModel):
     integration_token: str
     app_id: str
 
 
-class ShareDataRequest(BaseModel):
+class ShareDataRequest(FrozenModel):
     integration_token: str
     data: Dict[str, Any]
     render_prompt: str
 
 
-class ShareDataResponse(BaseModel):
+class ShareDataResponse(FrozenModel):
+    success: bool
+    message: str
+
+
+# Upper bound on items per /batch-share request (each one is hashed, looked up and possibly generated)
+MAX_BATCH_ITEMS = 100
+
+
+class BatchShareRequest(FrozenModel):
+    items: List[ShareDataRequest] = Field(..., max_length=MAX_BATCH_ITEMS)
+
+
+class RegisterAndShareRequest(FrozenModel):
+    registration_token: str
+    app_name: str
+    data: Dict[str, Any]
+    render_prompt: str
+
+
+class RegisterAndShareResponse(FrozenModel):
+    integration_token: str
+    app_id: str
     success: bool
     message: str
 
 
-class CreateUserWidgetRequest(BaseModel):
+class CreateUserWidgetRequest(FrozenModel):
     prompt: str
     widget_name: Optional[str] = "User Widget"
 
 
-class CreateUserWidgetResponse(BaseModel):
+class CreateUserWidgetResponse(FrozenModel):
     success: bool
     widget_id: str
     message: str
 
 
-class EditUserWidgetRequest(BaseModel):
+class EditUserWidgetRequest(FrozenModel):
     widget_id: str
     prompt: str
 
 
-class EditUserWidgetResponse(BaseModel):
+class EditUserWidgetResponse(FrozenModel):
     success: bool
     message: str
 
 
-class DeleteUserWidgetRequest(BaseModel):
+class DeleteUserWidgetRequest(FrozenModel):
     widget_id: str
 
 
-class DeleteUserWidgetResponse(BaseModel):
+class DeleteUserWidgetResponse(FrozenModel):
     success: bool
     message: str
 
 
-class RefreshAppWidgetResponse(BaseModel):
+class RefreshAppWidgetResponse(FrozenModel):
     success: bool
     html: str
     message: str
 
 
-class DeleteAppWidgetResponse(BaseModel):
+class DeleteAppWidgetResponse(FrozenModel):
     success: bool
     message: str
 
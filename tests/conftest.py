@@ -3,53 +3,62 @@ Pytest configuration and fixtures for testing.
 """
 
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-from bson import ObjectId
+import orjson
+from unittest.mock import Mock, patch, MagicMock, AsyncMock
+from bson import ObjectId, BSON
+from bson.raw_bson import RawBSONDocument
+from pymongo.results import InsertOneResult, UpdateResult, DeleteResult
 from datetime import datetime
 
-# Import app after setting up mocks
-from main import app
+from config import Settings
+from models import RegisterRequest, ShareDataRequest
 
-# Try to import TestClient - handle version differences
-try:
-    from fastapi.testclient import TestClient
-except ImportError:
-    from starlette.testclient import TestClient
+# Timestamp for all mock documents: fixed, so documents compare equal across runs without freezing the clock
+MOCK_TIMESTAMP = datetime(2024, 1, 1)
 
+# main (FastAPI, Anthropic, the MongoDB client) is imported by the fixtures that need it,
+# so config and generator tests collect and run without loading the app
 
-@pytest.fixture
+
+@pytest.fixture(scope="session")
 def client():
-    """Create a test client for the FastAPI app."""
+    """
+    Test client for the FastAPI app, shared by all tests (it holds no per-test state:
+    handlers read the patched collections at request time).
+    Not entered as a context manager, so the lifespan (MongoDB indexes, pool warm-up) does not run.
+    """
+    from main import app
     # Use starlette's TestClient directly to avoid version conflicts
     from starlette.testclient import TestClient as StarletteTestClient
     return StarletteTestClient(app)
 
 
-@pytest.fixture
+# Static tokens and documents are built once per session; tests copy them ({**doc, ...}) rather than mutate
+@pytest.fixture(scope="session")
 def mock_registration_token():
     """Mock registration token for testing."""
     return "test_registration_token_123"
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def mock_integration_token():
     """Mock integration token for testing."""
     return "test_integration_token_456"
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def mock_app_doc(mock_integration_token):
     """Mock app document."""
     return {
         "_id": ObjectId(),
         "app_name": "Test App",
         "integration_token": mock_integration_token,
-        "registration_date": datetime.utcnow(),
-        "created_at": datetime.utcnow()
+        "registration_date": MOCK_TIMESTAMP,
+        "created_at": MOCK_TIMESTAMP
     }
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def mock_widget_doc(mock_app_doc):
     """Mock widget document."""
     return {
@@ -58,12 +67,12 @@ def mock_widget_doc(mock_app_doc):
         "data": {"test": "data"},
         "render_prompt": "Test prompt",
         "generated_html": "<div>Test HTML</div>",
-        "updated_at": datetime.utcnow(),
+        "updated_at": MOCK_TIMESTAMP,
         "user_created": False
     }
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def mock_user_widget_doc():
     """Mock user-created widget document."""
     return {
@@ -71,74 +80,224 @@ def mock_user_widget_doc():
         "widget_name": "User Widget",
         "render_prompt": "User prompt",
         "generated_html": "<div>User HTML</div>",
-        "created_at": datetime.utcnow(),
+        "created_at": MOCK_TIMESTAMP,
         "user_created": True
     }
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
+def missing_object_id():
+    """Well-formed id that matches no mock document (for not-found tests)."""
+    return str(ObjectId())
+
+
+@pytest.fixture(scope="session")
 def mock_ai_response():
     """Mock AI generation response."""
     return "<div class='widget'>Generated Widget HTML</div>"
 
 
-@pytest.fixture(autouse=True)
-def mock_database_collections(mock_app_doc, mock_widget_doc, mock_user_widget_doc):
-    """Mock database collections for all tests."""
-    with patch('main.apps_collection') as mock_apps, \
-         patch('main.widgets_collection') as mock_widgets, \
-         patch('dependencies.apps_collection') as mock_apps_dep, \
-         patch('dependencies.widgets_collection') as mock_widgets_dep:
-        
-        # Setup mock apps collection
-        mock_apps.insert_one.return_value = Mock(inserted_id=mock_app_doc["_id"])
-        mock_apps.find_one.return_value = mock_app_doc
-        mock_apps.find.return_value = [mock_app_doc]
-        mock_apps.delete_one.return_value = Mock(deleted_count=1)
-        mock_apps.update_one.return_value = Mock(modified_count=1)
-        
-        # Setup mock widgets collection
-        mock_widgets.find_one.return_value = mock_widget_doc
-        mock_widgets.find.return_value = [mock_widget_doc, mock_user_widget_doc]
-        mock_widgets.insert_one.return_value = Mock(inserted_id=mock_user_widget_doc["_id"])
-        mock_widgets.update_one.return_value = Mock(modified_count=1)
-        mock_widgets.delete_one.return_value = Mock(deleted_count=1)
-        
-        # Same for dependencies
-        mock_apps_dep.find_one.return_value = mock_app_doc
-        mock_widgets_dep.find_one.return_value = mock_widget_doc
-        
-        yield {
-            "apps": mock_apps,
-            "widgets": mock_widgets
-        }
-
-
-@pytest.fixture(autouse=True)
-def mock_ai_generator(mock_ai_response):
-    """Mock AI generator for all tests."""
-    async def async_mock(*args, **kwargs):
-        return mock_ai_response
+# Request models are frozen, so tests share them; use model_copy(update=...) for variants
+@pytest.fixture(scope="session")
+def valid_register_request(mock_registration_token):
+    """Registration request carrying the configured registration token."""
+    return RegisterRequest(registration_token=mock_registration_token, app_name="Test App")
+
+
+@pytest.fixture(scope="session")
+def valid_share_request(mock_integration_token):
+    """Share request carrying the mock app's integration token."""
+    return ShareDataRequest(
+        integration_token=mock_integration_token,
+        data={"test": "data"},
+        render_prompt="Test prompt"
+    )
+
+
+@pytest.fixture(scope="session")
+def share_data_body(mock_integration_token):
+    """/share-data request body for the mock app, JSON-encoded once (post with content=)."""
+    return orjson.dumps({
+        "integration_token": mock_integration_token,
+        "data": {"test": "data"},
+        "render_prompt": "Create a test widget"
+    })
+
+
+# Write results are immutable, so one instance of each serves every test
+@pytest.fixture(scope="session")
+def app_insert_result(mock_app_doc):
+    """Result of inserting the mock app."""
+    return InsertOneResult(mock_app_doc["_id"], acknowledged=True)
+
+
+@pytest.fixture(scope="session")
+def widget_insert_result(mock_user_widget_doc):
+    """Result of inserting the mock user widget."""
+    return InsertOneResult(mock_user_widget_doc["_id"], acknowledged=True)
+
+
+@pytest.fixture(scope="session")
+def update_one_result():
+    """Result of an update that modified one document."""
+    return UpdateResult({"n": 1, "nModified": 1}, acknowledged=True)
+
+
+@pytest.fixture(scope="session")
+def delete_one_result():
+    """Result of a delete that removed one document."""
+    return DeleteResult({"n": 1}, acknowledged=True)
+
+
+@pytest.fixture(scope="session")
+def delete_none_result():
+    """Result of a delete that matched nothing."""
+    return DeleteResult({"n": 0}, acknowledged=True)
+
+
+def make_cursor(docs):
+    """
+    Build a mock async cursor returning docs.
+    Chained calls (sort, max_time_ms, ...) return the cursor itself; to_list is awaitable.
+    """
+    cursor = MagicMock()
+    cursor.sort.return_value = cursor
+    cursor.max_time_ms.return_value = cursor
+    cursor.to_list = AsyncMock(return_value=list(docs))
+    return cursor
+
+
+@pytest.fixture
+def mock_cursor():
+    """Factory for mock async cursors (collection.find(...) results)."""
+    return make_cursor
+
+
+def find_one_in(docs):
+    """
+    side_effect for a mocked find_one: the first doc whose fields equal every plain value in the query.
+    Operator conditions ({"$ne": ...}) are not evaluated; unknown ids and tokens find nothing.
+    """
+    def find_one(query, *args, **kwargs):
+        return next(
+            (doc for doc in docs if all(isinstance(v, dict) or doc.get(k) == v for k, v in query.items())),
+            None
+        )
+    return find_one
+
+
+@pytest.fixture(scope="session")
+def session_collections():
+    """
+    AsyncMock collections bound into main and dependencies once for the whole session.
+    mock_database_collections resets and configures them per test.
+    """
+    with patch('main.apps_collection', new_callable=AsyncMock) as mock_apps, \
+         patch('main.widgets_collection', new_callable=AsyncMock) as mock_widgets, \
+         patch('main.raw_widgets_collection', new_callable=AsyncMock) as mock_raw_widgets, \
+         patch('dependencies.apps_collection', new_callable=AsyncMock) as mock_apps_dep, \
+         patch('dependencies.widgets_collection', new_callable=AsyncMock) as mock_widgets_dep:
+        yield mock_apps, mock_widgets, mock_raw_widgets, mock_apps_dep, mock_widgets_dep
+
+
+@pytest.fixture
+def mock_database_collections(session_collections, mock_app_doc, mock_widget_doc, mock_user_widget_doc,
+                              app_insert_result, widget_insert_result, update_one_result, delete_one_result):
+    """Mock database collections (applied to every endpoint and dependency test)."""
+    mock_apps, mock_widgets, mock_raw_widgets, mock_apps_dep, mock_widgets_dep = session_collections
+    for collection in session_collections:
+        collection.reset_mock(return_value=True, side_effect=True)
     
-    with patch('main.generate_widget_html', side_effect=async_mock) as mock_gen:
+    # Setup mock apps collection
+    mock_apps.insert_one.return_value = app_insert_result
+    mock_apps.find_one.return_value = mock_app_doc
+    mock_apps.find = Mock(return_value=make_cursor([mock_app_doc]))
+    mock_apps.aggregate.return_value = make_cursor([
+        {**mock_app_doc, "widget": [{"generated_html": mock_widget_doc["generated_html"]}]}
+    ])
+    mock_apps.delete_one.return_value = delete_one_result
+    mock_apps.update_one.return_value = update_one_result
+    
+    # Setup mock widgets collection
+    mock_widgets.find_one.return_value = mock_widget_doc
+    mock_widgets.find = Mock(return_value=make_cursor([mock_widget_doc, mock_user_widget_doc]))
+    mock_widgets.insert_one.return_value = widget_insert_result
+    mock_widgets.update_one.return_value = update_one_result
+    mock_widgets.delete_one.return_value = delete_one_result
+    
+    # Raw BSON reads of widgets (HTML passthrough)
+    mock_raw_widgets.find_one.return_value = RawBSONDocument(
+        BSON.encode({"_id": mock_widget_doc["_id"], "generated_html": mock_widget_doc["generated_html"]})
+    )
+    
+    # Dependencies look documents up by token or id, so answer from the mock documents by query
+    mock_apps_dep.find_one.side_effect = find_one_in([mock_app_doc])
+    mock_widgets_dep.find_one.side_effect = find_one_in([mock_widget_doc, mock_user_widget_doc])
+    
+    return {
+        "apps": mock_apps,
+        "widgets": mock_widgets,
+        "raw_widgets": mock_raw_widgets,
+        "dependency_apps": mock_apps_dep,
+        "dependency_widgets": mock_widgets_dep
+    }
+
+
+@pytest.fixture
+def clear_dashboard_cache():
+    """Start every test without a cached dashboard page."""
+    with patch('main._dashboard_cache', None):
+        yield
+
+
+@pytest.fixture(scope="session")
+def stub_template():
+    """Minimal stand-in for dashboard.html, compiled once."""
+    from main import templates
+    return templates.from_string("<html><title>AI Dashboard</title>{{ widgets|length }} widgets</html>")
+
+
+@pytest.fixture
+def stub_dashboard_template(stub_template):
+    """Render the dashboard with the stub template (for tests that only check queries or caching)."""
+    with patch('main.templates.get_template', return_value=stub_template):
+        yield
+
+
+@pytest.fixture
+def mock_ai_generator(mock_ai_response):
+    """Mock AI generator (applied to every endpoint and dependency test)."""
+    with patch('main.generate_widget_html', new_callable=AsyncMock, return_value=mock_ai_response) as mock_gen:
         yield mock_gen
 
 
-@pytest.fixture(autouse=True)
+@pytest.fixture(scope="session")
 def mock_config_settings(mock_registration_token):
-    """Mock config settings for all tests."""
-    with patch('config.settings') as mock_settings:
-        mock_settings.registration_token = mock_registration_token
-        mock_settings.widget_refresh_interval = 30000
-        mock_settings.environment = "local"
-        mock_settings.is_production = False
-        yield mock_settings
-
-
-@pytest.fixture(autouse=True)
-def mock_database_client():
-    """Mock database client for health check."""
-    with patch('database.client') as mock_client:
-        mock_client.admin.command.return_value = {"ok": 1}
-        yield mock_client
+    """
+    Test settings, built once and bound into main and dependencies for the whole session.
+    Ignores .env so the registration token is always mock_registration_token.
+    """
+    test_settings = Settings(
+        _env_file=None,
+        environment="local",
+        registration_token=mock_registration_token,
+        widget_refresh_interval=30000
+    )
+    with patch('main.settings', test_settings), patch('dependencies.settings', test_settings):
+        yield test_settings
 
+
+@pytest.fixture
+def dependency_overrides():
+    """FastAPI dependency overrides for a single test; cleared afterwards."""
+    from main import app
+    yield app.dependency_overrides
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def app_test_environment(mock_config_settings, mock_database_collections, mock_ai_generator, clear_dashboard_cache):
+    """
+    Isolate the app from MongoDB, the Anthropic API and local .env settings.
+    Applied with pytestmark by endpoint and dependency tests; pure unit tests skip the setup.
+    """
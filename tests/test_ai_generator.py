@@ -2,9 +2,31 @@
 Unit tests for AI generator module.
 """
 
+import asyncio
 import pytest
-from unittest.mock import patch, Mock
-from ai_generator import generate_widget_html
+from unittest.mock import patch, Mock, AsyncMock
+import ai_generator
+from ai_generator import (
+    generate_widget_html, _widget_cache, _unavailable_models, _MODELS_TO_TRY,
+    _call_anthropic_api, close_anthropic_client, _clean_html, _extract_widget_html, _read_widget_stream,
+    widget_content_hash, is_error_widget
+)
+
+
+async def async_iter(items):
+    """Yield items as an async stream."""
+    for item in items:
+        yield item
+
+
+@pytest.fixture(autouse=True)
+def clear_widget_cache():
+    """Start every test with an empty response cache and no skipped models."""
+    _widget_cache.clear()
+    _unavailable_models.clear()
+    yield
+    _widget_cache.clear()
+    _unavailable_models.clear()
 
 
 class TestGenerateWidgetHTML:
@@ -27,13 +49,7 @@ class TestGenerateWidgetHTML:
         mock_response_text = "<div>Generated Widget</div>"
         
         with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
-             patch('asyncio.get_event_loop') as mock_loop:
-            
-            # Create a coroutine that returns the mock response
-            async def mock_run_executor(executor, func):
-                return mock_response_text
-            
-            mock_loop.return_value.run_in_executor = mock_run_executor
+             patch('ai_generator._call_anthropic_api', return_value=mock_response_text):
             
             result = await generate_widget_html(
                 data={},
@@ -49,12 +65,7 @@ class TestGenerateWidgetHTML:
         mock_response_text = "<div>Data Widget</div>"
         
         with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
-             patch('asyncio.get_event_loop') as mock_loop:
-            
-            async def mock_run_executor(executor, func):
-                return mock_response_text
-            
-            mock_loop.return_value.run_in_executor = mock_run_executor
+             patch('ai_generator._call_anthropic_api', return_value=mock_response_text):
             
             result = await generate_widget_html(
                 data={"temperature": 72, "city": "SF"},
@@ -69,12 +80,7 @@ class TestGenerateWidgetHTML:
         mock_response_text = "<div>Preserved Style Widget</div>"
         
         with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
-             patch('asyncio.get_event_loop') as mock_loop:
-            
-            async def mock_run_executor(executor, func):
-                return mock_response_text
-            
-            mock_loop.return_value.run_in_executor = mock_run_executor
+             patch('ai_generator._call_anthropic_api', return_value=mock_response_text):
             
             prompt_with_styles = """
             CRITICAL STYLE PRESERVATION REQUIREMENTS:
@@ -96,12 +102,7 @@ class TestGenerateWidgetHTML:
         mock_response_text = "<div>Fallback Widget</div>"
         
         with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
-             patch('asyncio.get_event_loop') as mock_loop:
-            
-            async def mock_run_executor(executor, func):
-                return mock_response_text
-            
-            mock_loop.return_value.run_in_executor = mock_run_executor
+             patch('ai_generator._call_anthropic_api', return_value=mock_response_text):
             
             result = await generate_widget_html(
                 data={"test": "data"},
@@ -117,12 +118,7 @@ class TestGenerateWidgetHTML:
         mock_response_text = "```html\n<div>Clean Widget</div>\n```"
         
         with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
-             patch('asyncio.get_event_loop') as mock_loop:
-            
-            async def mock_run_executor(executor, func):
-                return mock_response_text
-            
-            mock_loop.return_value.run_in_executor = mock_run_executor
+             patch('ai_generator._call_anthropic_api', return_value=mock_response_text):
             
             result = await generate_widget_html(
                 data={},
@@ -133,4 +129,218 @@ class TestGenerateWidgetHTML:
             assert "<div>Clean Widget</div>" in result or "Clean Widget" in result
             assert "```html" not in result
             assert "```" not in result
+    
+    @pytest.mark.asyncio
+    async def test_generation_error_message_escaped(self):
+        """Test that API error messages are HTML-escaped in the error widget."""
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._call_anthropic_api', side_effect=Exception("<script>alert(1)</script>")):
+            
+            result = await generate_widget_html(data={}, render_prompt="Test prompt")
+            
+            assert "Generation Error" in result
+            assert "&lt;script&gt;alert(1)&lt;/script&gt;" in result
+            assert "<script>" not in result
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_generations_limited(self):
+        """Test that API calls beyond the slot limit wait for a free slot."""
+        in_flight = 0
+        max_in_flight = 0
+        
+        async def slow_call(system_prompt, prompt):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return "<div>Widget</div>"
+        
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._generation_slots', asyncio.Semaphore(2)), \
+             patch('ai_generator._call_anthropic_api', side_effect=slow_call):
+            
+            await asyncio.gather(*(
+                generate_widget_html(data={"n": n}, render_prompt="Test prompt") for n in range(5)
+            ))
+            
+            assert max_in_flight == 2
+    
+    @pytest.mark.asyncio
+    async def test_identical_request_served_from_cache(self):
+        """Test that a repeated request does not call the API again."""
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._call_anthropic_api', return_value="<div>Cached Widget</div>") as mock_call:
+            
+            first = await generate_widget_html(data={"a": 1, "b": 2}, render_prompt="Test prompt")
+            second = await generate_widget_html(data={"a": 1, "b": 2}, render_prompt="Test prompt")
+            
+            assert first == second
+            assert mock_call.await_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_different_data_not_served_from_cache(self):
+        """Test that changed data triggers a new generation."""
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._call_anthropic_api', return_value="<div>Widget</div>") as mock_call:
+            
+            await generate_widget_html(data={"a": 1}, render_prompt="Test prompt")
+            await generate_widget_html(data={"a": 2}, render_prompt="Test prompt")
+            
+            assert mock_call.await_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_use_cache_false_regenerates(self):
+        """Test that use_cache=False always calls the API."""
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._call_anthropic_api') as mock_call:
+            mock_call.side_effect = ["<div>Widget 1</div>", "<div>Widget 2</div>"]
+            
+            await generate_widget_html(data={}, render_prompt="Test prompt", is_user_prompt=True)
+            result = await generate_widget_html(data={}, render_prompt="Test prompt", is_user_prompt=True, use_cache=False)
+            
+            assert "Widget 2" in result
+            assert mock_call.await_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_static_instructions_sent_as_cached_system_block(self):
+        """Test that static instructions are sent as a cacheable system block."""
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._async_client') as mock_client:
+            
+            mock_stream = mock_client.messages.stream
+            mock_stream.return_value.__aenter__.return_value.text_stream = async_iter(["<div>Widget</div>"])
+            
+            await generate_widget_html(
+                data={"temperature": 72},
+                render_prompt="Show weather data"
+            )
+            
+            kwargs = mock_stream.call_args.kwargs
+            assert kwargs["system"][0]["cache_control"] == {"type": "ephemeral"}
+            assert "REQUIREMENTS:" in kwargs["system"][0]["text"]
+            assert "REQUIREMENTS:" not in kwargs["messages"][0]["content"]
+            assert "Show weather data" in kwargs["messages"][0]["content"]
+    
+    def test_content_hash_matches_equal_inputs(self):
+        """Test that the content hash only changes when the data or prompt changes."""
+        base = widget_content_hash({"a": 1, "b": 2}, "Show data")
+        assert widget_content_hash({"a": 1, "b": 2}, "Show data") == base
+        assert widget_content_hash({"a": 1, "b": 3}, "Show data") != base
+        assert widget_content_hash({"a": 1, "b": 2}, "Show other data") != base
+    
+    @pytest.mark.asyncio
+    async def test_error_widgets_detected(self):
+        """Test that error widgets are told apart from generated HTML."""
+        with patch('ai_generator.ANTHROPIC_API_KEY', ""):
+            assert is_error_widget(await generate_widget_html({"a": 1}, "Show data"))
+        
+        with patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch('ai_generator._call_anthropic_api', new_callable=AsyncMock, side_effect=Exception("API down")):
+            assert is_error_widget(await generate_widget_html({"a": 1}, "Show data"))
+        
+        assert not is_error_widget("<div class=\"widget-error\">Styled by the model</div>")
+
+
+class TestCallAnthropicAPI:
+    """Tests for model selection when calling the API."""
+    
+    @pytest.mark.asyncio
+    async def test_not_found_model_skipped_on_later_calls(self):
+        """Test that a model returning not_found is not retried on the next call."""
+        def stream(model, **kwargs):
+            if model == _MODELS_TO_TRY[0]:
+                raise Exception("Error code: 404 - not_found_error")
+            context = Mock()
+            context.__aenter__ = AsyncMock(return_value=Mock(text_stream=async_iter(["<div>Widget</div>"])))
+            context.__aexit__ = AsyncMock(return_value=False)
+            return context
+        
+        with patch('ai_generator._async_client') as mock_client:
+            mock_client.messages.stream.side_effect = stream
+            
+            assert await _call_anthropic_api("system", "prompt") == "<div>Widget</div>"
+            assert await _call_anthropic_api("system", "prompt") == "<div>Widget</div>"
+            
+            models = [c.kwargs["model"] for c in mock_client.messages.stream.call_args_list]
+            assert models == [_MODELS_TO_TRY[0], _MODELS_TO_TRY[1], _MODELS_TO_TRY[1]]
+    
+    @pytest.mark.asyncio
+    async def test_close_client_releases_shared_client(self):
+        """Test that closing the shared client drops it so a new one is created on next use."""
+        mock_client = Mock()
+        mock_client.close = AsyncMock()
+        
+        with patch('ai_generator._async_client', mock_client):
+            await close_anthropic_client()
+            
+            assert ai_generator._async_client is None
+            mock_client.close.assert_awaited_once()
 
+
+class TestCleanHTML:
+    """Tests for HTML cleanup of full documents."""
+    
+    def test_strips_document_wrappers(self):
+        """Test that document-level tags are removed and head styles kept."""
+        html = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Widget</title>
+<style>.w { color: red; }</style>
+</head>
+<body class="x">
+<div class="w">Content</div>
+</body>
+</html>"""
+        result = _clean_html(html)
+        
+        assert result.startswith("<style>.w { color: red; }</style>")
+        assert '<div class="w">Content</div>' in result
+        for tag in ("<!DOCTYPE", "<html", "</html>", "<head", "<meta", "<title", "<body", "</body>"):
+            assert tag not in result
+
+    def test_fragment_left_untouched(self):
+        """Test that a widget fragment without wrappers is returned as-is."""
+        html = "<style>.w { color: red; }</style>\n<div class=\"w\"><header>Title</header></div>"
+
+        assert _clean_html(html) == html
+
+
+class TestExtractWidgetHTML:
+    """Tests for extracting widget HTML from model responses."""
+    
+    def test_html_document_stops_at_explanation(self):
+        """Test that explanatory text inside the document is cut off."""
+        response = "<html><body><div>Widget</div>\nThis widget shows data. Here's more.</body></html>"
+        result = _extract_widget_html(response)
+        
+        assert result == "<div>Widget</div>"
+    
+    def test_code_block_stops_at_explanation(self):
+        """Test that a generic code block is cut at the first explanation marker."""
+        response = "```\n<div>Widget</div>\nThe design uses flexbox\n```"
+        result = _extract_widget_html(response)
+        
+        assert result == "<div>Widget</div>"
+
+
+class TestReadWidgetStream:
+    """Tests for collecting streamed model output."""
+    
+    @pytest.mark.asyncio
+    async def test_stops_after_closing_fence(self):
+        """Test that reading stops once the ```html block is closed."""
+        chunks = ["Here it is:\n``", "`ht", "ml\n<div>Widget</div>\n`", "``", "\nThis widget shows", " more text"]
+        stream = async_iter(chunks)
+        result = await _read_widget_stream(stream)
+        
+        assert result == "Here it is:\n```html\n<div>Widget</div>\n```"
+        assert [chunk async for chunk in stream] == ["\nThis widget shows", " more text"]
+    
+    @pytest.mark.asyncio
+    async def test_reads_everything_without_fence(self):
+        """Test that responses without a markdown fence are read in full."""
+        chunks = ["<div>", "Widget", "</div>"]
+        assert await _read_widget_stream(async_iter(chunks)) == "<div>Widget</div>"
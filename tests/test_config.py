@@ -4,10 +4,28 @@ Unit tests for configuration management.
 
 import pytest
 import os
+from contextlib import contextmanager
 from unittest.mock import patch
 from pydantic import ValidationError
 
-from config import Settings, settings
+from config import Settings, settings, get_settings
+
+
+@contextmanager
+def settings_from_env(env: dict):
+    """Build Settings from exactly the given environment variables (kept set while in use)."""
+    with patch.dict(os.environ, env, clear=True):
+        yield Settings()
+
+
+@pytest.fixture
+def uncached_settings():
+    """Clear the get_settings cache for a test, then cache the shared settings instance again."""
+    get_settings.cache_clear()
+    yield
+    get_settings.cache_clear()
+    with patch('config.Settings', return_value=settings):
+        get_settings()
 
 
 class TestSettings:
@@ -20,6 +38,8 @@ class TestSettings:
             assert test_settings.environment == "local"
             assert test_settings.mongodb_db_name == "ai_dashboard"
             assert test_settings.widget_refresh_interval == 30000
+            assert test_settings.mongodb_max_pool_size == 100
+            assert test_settings.mongodb_warm_connections == 5
     
     def test_environment_variable_loading(self):
         """Test loading from environment variables."""
@@ -37,29 +57,27 @@ class TestSettings:
             assert test_settings.anthropic_api_key == "test_key"
             assert test_settings.widget_refresh_interval == 60000
     
-    def test_is_production_property(self):
+    @pytest.mark.parametrize("env,expected", [
+        ({"ENVIRONMENT": "production"}, True),
+        ({"ENVIRONMENT": "local"}, False),
+        ({"DYNO": "web.1"}, True),  # Auto-detection via DYNO
+    ])
+    def test_is_production_property(self, env, expected):
         """Test is_production property."""
-        with patch.dict(os.environ, {"ENVIRONMENT": "production"}, clear=True):
-            test_settings = Settings()
+        with settings_from_env(env) as test_settings:
+            assert test_settings.is_production is expected
+    
+    def test_is_production_evaluated_once(self):
+        """Test that is_production keeps its first value for the life of the instance."""
+        with settings_from_env({"DYNO": "web.1"}) as test_settings:
             assert test_settings.is_production is True
-        
-        with patch.dict(os.environ, {"ENVIRONMENT": "local"}, clear=True):
-            test_settings = Settings()
-            assert test_settings.is_production is False
-        
-        # Test auto-detection via DYNO
-        with patch.dict(os.environ, {"DYNO": "web.1"}, clear=True):
-            test_settings = Settings()
+        with patch.dict(os.environ, {}, clear=True):
             assert test_settings.is_production is True
     
-    def test_mongodb_uri_normalized(self):
+    @pytest.mark.parametrize("uri", ["mongodb://test:27017/", "mongodb://test:27017"])
+    def test_mongodb_uri_normalized(self, uri):
         """Test MongoDB URI normalization."""
-        with patch.dict(os.environ, {"MONGODB_URI": "mongodb://test:27017/"}, clear=True):
-            test_settings = Settings()
-            assert test_settings.mongodb_uri_normalized == "mongodb://test:27017"
-        
-        with patch.dict(os.environ, {"MONGODB_URI": "mongodb://test:27017"}, clear=True):
-            test_settings = Settings()
+        with settings_from_env({"MONGODB_URI": uri}) as test_settings:
             assert test_settings.mongodb_uri_normalized == "mongodb://test:27017"
     
     def test_widget_refresh_interval_type_conversion(self):
@@ -68,4 +86,25 @@ class TestSettings:
             test_settings = Settings()
             assert isinstance(test_settings.widget_refresh_interval, int)
             assert test_settings.widget_refresh_interval == 45000
-
+    
+    @pytest.mark.parametrize("value", ["0", "-1"])
+    def test_max_concurrent_generations_must_be_positive(self, value):
+        """Test that a generation limit below 1 is rejected when settings load."""
+        with pytest.raises(ValidationError):
+            with settings_from_env({"MAX_CONCURRENT_GENERATIONS": value}):
+                pass
+    
+    def test_get_settings_is_cached(self):
+        """Test that get_settings returns the shared instance."""
+        assert get_settings() is get_settings()
+        assert get_settings() is settings
+    
+    def test_get_settings_rereads_env_after_cache_clear(self, uncached_settings):
+        """Test that clearing the cache makes get_settings load the current environment."""
+        with patch.dict(os.environ, {"MONGODB_DB_NAME": "first_db"}, clear=True):
+            first = get_settings()
+        with patch.dict(os.environ, {"MONGODB_DB_NAME": "second_db"}, clear=True):
+            assert get_settings() is first
+            get_settings.cache_clear()
+            assert get_settings().mongodb_db_name == "second_db"
+        assert first.mongodb_db_name == "first_db"
@@ -3,42 +3,36 @@ Unit tests for FastAPI dependencies.
 """
 
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, AsyncMock
 from fastapi import HTTPException
-from bson import ObjectId
-from datetime import datetime
 
 from dependencies import (
+    check_database_connection,
     verify_registration_token,
     verify_integration_token,
     get_widget_by_id,
     get_app_widget_by_app_id
 )
-from models import RegisterRequest, ShareDataRequest
+
+
+pytestmark = pytest.mark.usefixtures("app_test_environment")
 
 
 class TestVerifyRegistrationToken:
     """Tests for verify_registration_token dependency."""
     
-    def test_valid_token(self, mock_registration_token):
+    @pytest.mark.asyncio
+    async def test_valid_token(self, valid_register_request):
         """Test with valid registration token."""
-        with patch('dependencies.settings') as mock_settings:
-            mock_settings.registration_token = mock_registration_token
-            request = RegisterRequest(
-                registration_token=mock_registration_token,
-                app_name="Test App"
-            )
-            result = verify_registration_token(request)
-            assert result == request
+        result = await verify_registration_token(valid_register_request)
+        assert result is valid_register_request
     
-    def test_invalid_token(self, mock_config_settings):
+    @pytest.mark.asyncio
+    async def test_invalid_token(self, valid_register_request):
         """Test with invalid registration token."""
-        request = RegisterRequest(
-            registration_token="wrong_token",
-            app_name="Test App"
-        )
+        request = valid_register_request.model_copy(update={"registration_token": "wrong_token"})
         with pytest.raises(HTTPException) as exc_info:
-            verify_registration_token(request)
+            await verify_registration_token(request)
         assert exc_info.value.status_code == 401
         assert "Invalid registration token" in str(exc_info.value.detail)
 
@@ -47,36 +41,41 @@ class TestVerifyIntegrationToken:
     """Tests for verify_integration_token dependency."""
     
     @pytest.mark.asyncio
-    async def test_valid_integration_token(self, mock_app_doc):
+    async def test_valid_integration_token(self, valid_share_request, mock_app_doc):
         """Test with valid integration token."""
-        with patch('dependencies.apps_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_app_doc
-            
-            request = ShareDataRequest(
-                integration_token="test_integration_token_456",
-                data={"test": "data"},
-                render_prompt="Test prompt"
-            )
-            
-            result = await verify_integration_token(request)
-            assert result == mock_app_doc
+        result = await verify_integration_token(valid_share_request)
+        assert result == mock_app_doc
     
     @pytest.mark.asyncio
-    async def test_invalid_integration_token(self):
+    async def test_invalid_integration_token(self, valid_share_request):
         """Test with invalid integration token."""
-        with patch('dependencies.apps_collection') as mock_collection:
-            mock_collection.find_one.return_value = None
+        request = valid_share_request.model_copy(update={"integration_token": "invalid_token"})
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await verify_integration_token(request)
+        assert exc_info.value.status_code == 401
+        assert "Invalid integration token" in str(exc_info.value.detail)
+
+
+class TestCheckDatabaseConnection:
+    """Tests for check_database_connection dependency."""
+    
+    @pytest.mark.asyncio
+    async def test_database_reachable(self):
+        """Test that a successful ping reports no error."""
+        with patch('dependencies.client') as mock_client:
+            mock_client.admin.command = AsyncMock(return_value={"ok": 1})
             
-            request = ShareDataRequest(
-                integration_token="invalid_token",
-                data={"test": "data"},
-                render_prompt="Test prompt"
-            )
+            assert await check_database_connection() is None
+            mock_client.admin.command.assert_awaited_once_with('ping')
+    
+    @pytest.mark.asyncio
+    async def test_database_unreachable(self):
+        """Test that a failed ping is reported as an error message."""
+        with patch('dependencies.client') as mock_client:
+            mock_client.admin.command = AsyncMock(side_effect=Exception("Connection failed"))
             
-            with pytest.raises(HTTPException) as exc_info:
-                await verify_integration_token(request)
-            assert exc_info.value.status_code == 401
-            assert "Invalid integration token" in str(exc_info.value.detail)
+            assert await check_database_connection() == "Connection failed"
 
 
 class TestGetWidgetById:
@@ -85,26 +84,31 @@ class TestGetWidgetById:
     @pytest.mark.asyncio
     async def test_widget_found(self, mock_user_widget_doc):
         """Test finding widget by ID."""
-        widget_id = str(mock_user_widget_doc["_id"])
-        
-        with patch('dependencies.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_user_widget_doc
-            
-            result = await get_widget_by_id(widget_id, user_created=True)
-            assert result == mock_user_widget_doc
+        result = await get_widget_by_id(str(mock_user_widget_doc["_id"]), user_created=True)
+        assert result == mock_user_widget_doc
     
     @pytest.mark.asyncio
-    async def test_widget_not_found(self):
+    async def test_widget_not_found(self, missing_object_id):
         """Test when widget is not found."""
-        widget_id = str(ObjectId())
-        
-        with patch('dependencies.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = None
-            
-            with pytest.raises(HTTPException) as exc_info:
-                await get_widget_by_id(widget_id, user_created=True)
-            assert exc_info.value.status_code == 404
-            assert "Widget not found" in str(exc_info.value.detail)
+        with pytest.raises(HTTPException) as exc_info:
+            await get_widget_by_id(missing_object_id, user_created=True)
+        assert exc_info.value.status_code == 404
+        assert "Widget not found" in str(exc_info.value.detail)
+    
+    @pytest.mark.asyncio
+    async def test_app_widget_not_returned_as_user_widget(self, mock_widget_doc):
+        """Test that an app widget's ID does not match a user widget lookup."""
+        with pytest.raises(HTTPException) as exc_info:
+            await get_widget_by_id(str(mock_widget_doc["_id"]), user_created=True)
+        assert exc_info.value.status_code == 404
+    
+    @pytest.mark.asyncio
+    async def test_invalid_widget_id(self, mock_database_collections):
+        """Test that a malformed ID returns 404 without querying MongoDB."""
+        with pytest.raises(HTTPException) as exc_info:
+            await get_widget_by_id("not-an-object-id", user_created=True)
+        assert exc_info.value.status_code == 404
+        mock_database_collections["dependency_widgets"].find_one.assert_not_called()
 
 
 class TestGetAppWidgetByAppId:
@@ -113,24 +117,13 @@ class TestGetAppWidgetByAppId:
     @pytest.mark.asyncio
     async def test_app_widget_found(self, mock_widget_doc):
         """Test finding app widget by app_id."""
-        app_id = mock_widget_doc["app_id"]
-        
-        with patch('dependencies.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_widget_doc
-            
-            result = await get_app_widget_by_app_id(app_id)
-            assert result == mock_widget_doc
+        result = await get_app_widget_by_app_id(mock_widget_doc["app_id"])
+        assert result == mock_widget_doc
     
     @pytest.mark.asyncio
-    async def test_app_widget_not_found(self):
+    async def test_app_widget_not_found(self, missing_object_id):
         """Test when app widget is not found."""
-        app_id = str(ObjectId())
-        
-        with patch('dependencies.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = None
-            
-            with pytest.raises(HTTPException) as exc_info:
-                await get_app_widget_by_app_id(app_id)
-            assert exc_info.value.status_code == 404
-            assert "App widget not found" in str(exc_info.value.detail)
-
+        with pytest.raises(HTTPException) as exc_info:
+            await get_app_widget_by_app_id(missing_object_id)
+        assert exc_info.value.status_code == 404
+        assert "App widget not found" in str(exc_info.value.detail)
@@ -3,68 +3,98 @@ Unit tests for FastAPI endpoints.
 """
 
 import pytest
+import orjson
 from unittest.mock import Mock, patch
 from fastapi import status
 from bson import ObjectId
-from datetime import datetime
+
+from main import extract_style_blocks, build_style_preservation_prompt
+import ai_generator
+from ai_generator import widget_content_hash
+from dependencies import (
+    check_database_connection, verify_register_and_share_token
+)
+from models import RegisterAndShareRequest, MAX_BATCH_ITEMS
+
+
+pytestmark = pytest.mark.usefixtures("app_test_environment")
+
+JSON_HEADERS = {"content-type": "application/json"}
+
+
+def json_body(response):
+    """Decode a JSON response with orjson (the encoder the app itself uses)."""
+    return orjson.loads(response.content)
+
+
+# Dependency overrides standing in for token and database checks (async, like the dependencies they replace)
+async def accept_register_and_share(request: RegisterAndShareRequest) -> RegisterAndShareRequest:
+    return request
+
+
+async def database_connected():
+    return None
+
+
+async def database_unreachable():
+    return "Connection failed"
+
+
+# Per-case setup for TestErrorResponses: (mock collections, dependency overrides) -> None
+def no_setup(collections, overrides):
+    pass
+
+
+def widget_missing(collections, overrides):
+    collections["raw_widgets"].find_one.return_value = None
+
+
+def app_widget_missing(collections, overrides):
+    collections["widgets"].find_one.return_value = None
 
 
 class TestHealthCheck:
     """Tests for health check endpoint."""
     
-    def test_health_check_success(self, client, mock_database_client):
+    def test_health_check_success(self, client, dependency_overrides):
         """Test successful health check."""
+        dependency_overrides[check_database_connection] = database_connected
+        
         response = client.get("/health")
         assert response.status_code == status.HTTP_200_OK
-        data = response.json()
+        data = json_body(response)
         assert data["status"] == "healthy"
         assert "environment" in data
         assert "database" in data
     
-    def test_health_check_database_failure(self, client):
+    def test_health_check_database_failure(self, client, dependency_overrides):
         """Test health check when database is unavailable."""
-        with patch('database.client') as mock_client:
-            mock_client.admin.command.side_effect = Exception("Connection failed")
-            response = client.get("/health")
-            assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
-            data = response.json()
-            assert data["status"] == "unhealthy"
+        dependency_overrides[check_database_connection] = database_unreachable
+        
+        response = client.get("/health")
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        data = json_body(response)
+        assert data["status"] == "unhealthy"
+        assert data["error"] == "Connection failed"
 
 
 class TestRegisterApp:
     """Tests for app registration endpoint."""
     
     def test_register_app_success(self, client, mock_registration_token, mock_app_doc):
-        """Test successful app registration."""
-        with patch('dependencies.settings') as mock_settings, \
-             patch('main.settings') as mock_main_settings:
-            mock_settings.registration_token = mock_registration_token
-            mock_main_settings.registration_token = mock_registration_token
-            
-            response = client.post(
-                "/register",
-                json={
-                    "registration_token": mock_registration_token,
-                    "app_name": "Test App"
-                }
-            )
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert "integration_token" in data
-            assert "app_id" in data
-            assert len(data["integration_token"]) > 0
-    
-    def test_register_app_invalid_token(self, client):
-        """Test registration with invalid token."""
+        """Test successful app registration through the real registration token check."""
         response = client.post(
             "/register",
             json={
-                "registration_token": "wrong_token",
+                "registration_token": mock_registration_token,
                 "app_name": "Test App"
             }
         )
-        assert response.status_code == status.HTTP_401_UNAUTHORIZED
-        assert "Invalid registration token" in response.json()["detail"]
+        assert response.status_code == status.HTTP_200_OK
+        data = json_body(response)
+        assert "integration_token" in data
+        assert data["app_id"] == str(mock_app_doc["_id"])
+        assert len(data["integration_token"]) > 0
     
     def test_register_app_missing_fields(self, client):
         """Test registration with missing required fields."""
@@ -81,171 +111,444 @@ class TestRegisterApp:
 class TestShareData:
     """Tests for share-data endpoint."""
     
-    def test_share_data_success(self, client, mock_integration_token, mock_app_doc, mock_ai_response):
+    def test_share_data_success(self, client, share_data_body, mock_ai_response,
+                                mock_database_collections, mock_ai_generator):
         """Test successful data sharing."""
+        mock_database_collections["widgets"].find_one.return_value = None
+        
+        response = client.post("/share-data", content=share_data_body, headers=JSON_HEADERS)
+        assert response.status_code == status.HTTP_200_OK
+        data = json_body(response)
+        assert data["success"] is True
+        assert "message" in data
+        mock_ai_generator.assert_called_once()
+        widget_doc = mock_database_collections["widgets"].update_one.call_args.args[1]["$set"]
+        assert widget_doc["generated_html"] == mock_ai_response
+        assert widget_doc["content_hash"] == widget_content_hash({"test": "data"}, "Create a test widget")
+    
+    def test_share_data_unchanged_skips_generation(self, client, share_data_body,
+                                                   mock_database_collections, mock_ai_generator):
+        """Test that resharing the data and prompt of the stored widget does not regenerate it."""
+        response = client.post("/share-data", content=share_data_body, headers=JSON_HEADERS)
+        assert response.status_code == status.HTTP_200_OK
+        assert json_body(response)["success"] is True
+        mock_ai_generator.assert_not_called()
+        mock_database_collections["widgets"].update_one.assert_not_called()
+        query = mock_database_collections["widgets"].find_one.call_args.args[0]
+        assert query["content_hash"] == widget_content_hash({"test": "data"}, "Create a test widget")
+
+
+class TestBatchShare:
+    """Tests for the batch share endpoint."""
+    
+    def test_batch_share_mixed_items(self, client, mock_database_collections, mock_ai_generator,
+                                     mock_integration_token, mock_app_doc, mock_cursor):
+        """Test that results follow request order and only changed, valid items are generated."""
+        other_app = {"_id": ObjectId(), "integration_token": "other_token"}
+        mock_database_collections["apps"].find = Mock(return_value=mock_cursor([mock_app_doc, other_app]))
+        mock_database_collections["widgets"].find = Mock(return_value=mock_cursor([
+            {"app_id": str(other_app["_id"]), "content_hash": widget_content_hash({"n": 1}, "Unchanged")}
+        ]))
+        
         response = client.post(
-            "/share-data",
+            "/batch-share",
+            json={"items": [
+                {"integration_token": "invalid_token", "data": {"n": 0}, "render_prompt": "Bad token"},
+                {"integration_token": mock_integration_token, "data": {"n": 2}, "render_prompt": "Changed"},
+                {"integration_token": "other_token", "data": {"n": 1}, "render_prompt": "Unchanged"}
+            ]}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        results = json_body(response)
+        assert [r["success"] for r in results] == [False, True, True]
+        assert results[0]["message"] == "Invalid integration token"
+        assert "unchanged" in results[2]["message"].lower()
+        
+        mock_database_collections["apps"].find.assert_called_once()
+        mock_ai_generator.assert_called_once_with({"n": 2}, "Changed")
+        operations = mock_database_collections["widgets"].bulk_write.call_args.args[0]
+        assert len(operations) == 1
+        assert operations[0]._filter == {"app_id": str(mock_app_doc["_id"])}
+    
+    def test_batch_share_same_app_twice(self, client, mock_database_collections, mock_ai_generator,
+                                        mock_integration_token, mock_cursor):
+        """Test that only the last item for an app is generated and written."""
+        mock_database_collections["widgets"].find = Mock(return_value=mock_cursor([]))
+        
+        response = client.post(
+            "/batch-share",
+            json={"items": [
+                {"integration_token": mock_integration_token, "data": {"n": 1}, "render_prompt": "Old"},
+                {"integration_token": mock_integration_token, "data": {"n": 2}, "render_prompt": "New"}
+            ]}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert "superseded" in json_body(response)[0]["message"]
+        mock_ai_generator.assert_called_once_with({"n": 2}, "New")
+        operations = mock_database_collections["widgets"].bulk_write.call_args.args[0]
+        assert len(operations) == 1
+        assert mock_database_collections["widgets"].bulk_write.call_args.kwargs == {"ordered": False}
+    
+    def test_batch_share_nothing_to_generate(self, client, mock_database_collections, mock_ai_generator, mock_cursor):
+        """Test that a batch with no valid items writes nothing."""
+        mock_database_collections["apps"].find = Mock(return_value=mock_cursor([]))
+        
+        response = client.post(
+            "/batch-share",
+            json={"items": [{"integration_token": "invalid_token", "data": {}, "render_prompt": "Bad token"}]}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert json_body(response)[0]["success"] is False
+        mock_ai_generator.assert_not_called()
+        mock_database_collections["widgets"].bulk_write.assert_not_called()
+    
+    def test_batch_share_too_many_items(self, client, mock_database_collections, mock_ai_generator):
+        """Test that a batch over the item limit is rejected before any lookup."""
+        item = {"integration_token": "invalid_token", "data": {}, "render_prompt": "Too many"}
+        response = client.post("/batch-share", json={"items": [item] * (MAX_BATCH_ITEMS + 1)})
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+        mock_database_collections["apps"].find.assert_not_called()
+        mock_ai_generator.assert_not_called()
+
+
+class TestRegisterAndShare:
+    """Tests for the combined register-and-share endpoint."""
+    
+    def test_register_and_share_success(self, client, dependency_overrides, mock_database_collections,
+                                        mock_ai_generator, mock_ai_response):
+        """Test that one request registers the app and generates its widget."""
+        dependency_overrides[verify_register_and_share_token] = accept_register_and_share
+        
+        response = client.post(
+            "/register-and-share",
             json={
-                "integration_token": mock_integration_token,
+                "registration_token": "test_token",
+                "app_name": "Test App",
                 "data": {"test": "data"},
                 "render_prompt": "Create a test widget"
             }
         )
         assert response.status_code == status.HTTP_200_OK
-        data = response.json()
+        data = json_body(response)
         assert data["success"] is True
-        assert "message" in data
+        assert len(data["integration_token"]) > 0
+        
+        app_doc = mock_database_collections["apps"].insert_one.call_args.args[0]
+        assert app_doc["app_name"] == "Test App"
+        assert app_doc["integration_token"] == data["integration_token"]
+        mock_ai_generator.assert_called_once_with({"test": "data"}, "Create a test widget")
+        query, update = mock_database_collections["widgets"].update_one.call_args.args
+        assert query == {"app_id": data["app_id"]}
+        assert update["$set"]["generated_html"] == mock_ai_response
+        mock_database_collections["widgets"].find_one.assert_not_called()
     
-    def test_share_data_invalid_token(self, client):
-        """Test data sharing with invalid integration token."""
-        with patch('dependencies.apps_collection') as mock_collection:
-            mock_collection.find_one.return_value = None
-            
-            response = client.post(
-                "/share-data",
-                json={
-                    "integration_token": "invalid_token",
-                    "data": {"test": "data"},
-                    "render_prompt": "Create a test widget"
-                }
-            )
-            assert response.status_code == status.HTTP_401_UNAUTHORIZED
-            assert "Invalid integration token" in response.json()["detail"]
+    def test_register_and_share_invalid_token(self, client, mock_database_collections):
+        """Test that nothing is registered with an invalid registration token."""
+        response = client.post(
+            "/register-and-share",
+            json={
+                "registration_token": "wrong_token",
+                "app_name": "Test App",
+                "data": {"test": "data"},
+                "render_prompt": "Create a test widget"
+            }
+        )
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+        mock_database_collections["apps"].insert_one.assert_not_called()
 
 
 class TestDashboard:
     """Tests for dashboard endpoint."""
     
-    def test_dashboard_success(self, client, mock_widget_doc, mock_user_widget_doc):
+    def test_dashboard_success(self, client, mock_database_collections, mock_user_widget_doc, mock_cursor):
         """Test successful dashboard rendering."""
-        with patch('main.apps_collection') as mock_apps, \
-             patch('main.widgets_collection') as mock_widgets:
-            
-            mock_apps.find.return_value = []
-            mock_widgets.find.return_value = [mock_user_widget_doc]
-            
-            response = client.get("/")
-            assert response.status_code == status.HTTP_200_OK
-            assert "text/html" in response.headers["content-type"]
-            assert "dashboard" in response.text.lower()
+        mock_database_collections["apps"].aggregate.return_value = mock_cursor([])
+        mock_database_collections["widgets"].find = Mock(return_value=mock_cursor([mock_user_widget_doc]))
+        
+        response = client.get("/")
+        assert response.status_code == status.HTTP_200_OK
+        assert "text/html" in response.headers["content-type"]
+        assert b"<title>AI Dashboard</title>" in response.content
+        assert mock_user_widget_doc["generated_html"] in response.text
+    
+    def test_dashboard_app_widgets_single_query(self, client, mock_database_collections, mock_app_doc, mock_cursor):
+        """Test that app widgets come from one joined query, not a lookup per app."""
+        mock_apps = mock_database_collections["apps"]
+        mock_widgets = mock_database_collections["widgets"]
+        mock_widgets.find = Mock(return_value=mock_cursor([]))
+        mock_apps.aggregate.return_value = mock_cursor([
+            {**mock_app_doc, "widget": [{"generated_html": "<div>App One</div>"}]},
+            {"_id": ObjectId(), "app_name": "No Widget App", "widget": []}
+        ])
+        
+        response = client.get("/")
+        assert response.status_code == status.HTTP_200_OK
+        assert "<div>App One</div>" in response.text
+        assert "No Widget App" in response.text
+        mock_apps.aggregate.assert_awaited_once()
+        mock_widgets.find_one.assert_not_called()
+    
+    def test_dashboard_user_widgets_before_app_widgets(self, client, mock_database_collections, mock_app_doc,
+                                                       mock_user_widget_doc, mock_cursor):
+        """Test that concurrently fetched widgets keep user widgets first."""
+        mock_database_collections["widgets"].find = Mock(return_value=mock_cursor([mock_user_widget_doc]))
+        mock_database_collections["apps"].aggregate.return_value = mock_cursor([
+            {**mock_app_doc, "widget": [{"generated_html": "<div>App Widget</div>"}]}
+        ])
+        
+        response = client.get("/")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.text.index(mock_user_widget_doc["generated_html"]) < response.text.index("<div>App Widget</div>")
+    
+    @pytest.mark.usefixtures("stub_dashboard_template")
+    def test_dashboard_projects_user_widget_fields(self, client, mock_database_collections):
+        """Test that user widgets are loaded without their data blobs."""
+        client.get("/")
+        
+        query, projection = mock_database_collections["widgets"].find.call_args.args
+        assert query == {"user_created": True}
+        assert "data" not in projection
+        assert projection["generated_html"] == 1
+    
+    def test_dashboard_escapes_app_names(self, client, mock_database_collections, mock_cursor):
+        """Test that app names are HTML-escaped while widget HTML is rendered as-is."""
+        mock_database_collections["widgets"].find = Mock(return_value=mock_cursor([]))
+        mock_database_collections["apps"].aggregate.return_value = mock_cursor([
+            {"_id": ObjectId(), "app_name": "<b>Evil</b>", "widget": [{"generated_html": "<div>Widget</div>"}]}
+        ])
+        
+        response = client.get("/")
+        assert "&lt;b&gt;Evil&lt;/b&gt;" in response.text
+        assert "<b>Evil</b>" not in response.text
+        assert "<div>Widget</div>" in response.text
+    
+    @pytest.mark.usefixtures("stub_dashboard_template")
+    def test_dashboard_served_from_cache(self, client, mock_database_collections):
+        """Test that a repeated page load does not query MongoDB again."""
+        first = client.get("/")
+        second = client.get("/")
+        
+        assert first.text == second.text
+        assert mock_database_collections["apps"].aggregate.await_count == 1
+    
+    @pytest.mark.usefixtures("stub_dashboard_template")
+    def test_dashboard_cache_invalidated_by_write(self, client, mock_database_collections, share_data_body):
+        """Test that sharing data re-renders the dashboard on the next load."""
+        client.get("/")
+        mock_database_collections["widgets"].find_one.return_value = None  # data changed
+        client.post("/share-data", content=share_data_body, headers=JSON_HEADERS)
+        client.get("/")
+        
+        assert mock_database_collections["apps"].aggregate.await_count == 2
+
+
+class TestStylePreservation:
+    """Tests for style extraction and the style preservation prompt used on refresh."""
+    
+    def test_extracts_each_style_block(self):
+        """Test that every closed style block is returned in order."""
+        html = '<STYLE type="text/css">.a { color: red; }</style><div></div><style>.b {}</STYLE>'
+        assert extract_style_blocks(html) == ['.a { color: red; }', '.b {}']
+    
+    def test_unclosed_style_ignored(self):
+        """Test that an unclosed style tag yields nothing."""
+        assert extract_style_blocks('<style>.a {}</style><style>.b {') == ['.a {}']
+    
+    def test_style_preservation_prompt_includes_current_styles(self):
+        """Test that the refresh prompt embeds the widget's current CSS."""
+        prompt = build_style_preservation_prompt("Show weather", ["  .a { color: red; }  ", ".b {}"])
+        
+        assert prompt.startswith("Show weather\n\nCRITICAL STYLE PRESERVATION REQUIREMENTS:\n")
+        assert "CURRENT WIDGET STYLES (preserve these):\n```css\n.a { color: red; }\n.b {}\n```\n" in prompt
+    
+    def test_style_preservation_prompt_without_styles(self):
+        """Test that no CSS section is added when the widget has no styles."""
+        prompt = build_style_preservation_prompt("Show weather", [])
+        
+        assert "CRITICAL STYLE PRESERVATION REQUIREMENTS" in prompt
+        assert "CURRENT WIDGET STYLES" not in prompt
+
+
+class TestWidgetRefresh:
+    """Tests for the cached widget HTML endpoint."""
+    
+    def test_refresh_widget_returns_stored_html(self, client, mock_app_doc, mock_widget_doc):
+        """Test that the stored HTML is returned without regeneration."""
+        response = client.get(f"/widget/{mock_app_doc['_id']}/refresh")
+        assert response.status_code == status.HTTP_200_OK
+        assert json_body(response) == {"html": mock_widget_doc["generated_html"]}
 
 
 class TestUserWidgets:
     """Tests for user widget endpoints."""
     
-    def test_create_user_widget_success(self, client, mock_user_widget_doc, mock_ai_response):
+    def test_create_user_widget_success(self, client, mock_database_collections, mock_user_widget_doc):
         """Test successful user widget creation."""
+        response = client.post(
+            "/api/user-widgets/create",
+            json={
+                "prompt": "Create a weather widget",
+                "widget_name": "Weather"
+            }
+        )
+        assert response.status_code == status.HTTP_200_OK
+        data = json_body(response)
+        assert data["success"] is True
+        assert data["widget_id"] == str(mock_user_widget_doc["_id"])
+        mock_database_collections["widgets"].insert_one.assert_awaited_once()
+    
+    @pytest.mark.parametrize("path, payload, expected_key", [
+        ("/api/user-widgets/edit", {"prompt": "Updated prompt"}, "success"),
+        ("/api/user-widgets/delete", {}, "success"),
+        ("/api/user-widgets/{widget_id}/refresh", None, "html"),
+    ], ids=["edit", "delete", "refresh"])
+    def test_existing_user_widget_success(self, client, mock_database_collections, mock_user_widget_doc,
+                                          path, payload, expected_key):
+        """Test successful edit, delete and refresh of an existing user widget."""
         widget_id = str(mock_user_widget_doc["_id"])
+        mock_database_collections["widgets"].find_one.return_value = mock_user_widget_doc
         
-        with patch('main.widgets_collection') as mock_collection:
-            mock_collection.insert_one.return_value = Mock(inserted_id=mock_user_widget_doc["_id"])
-            
-            response = client.post(
-                "/api/user-widgets/create",
-                json={
-                    "prompt": "Create a weather widget",
-                    "widget_name": "Weather"
-                }
-            )
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert data["success"] is True
-            assert "widget_id" in data
-    
-    def test_edit_user_widget_success(self, client, mock_user_widget_doc, mock_ai_response):
-        """Test successful user widget edit."""
-        widget_id = str(mock_user_widget_doc["_id"])
+        response = client.post(
+            path.format(widget_id=widget_id),
+            json=None if payload is None else {"widget_id": widget_id, **payload}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert json_body(response)[expected_key]
+    
+    @pytest.mark.parametrize("path, payload", [
+        ("/api/user-widgets/create", {"prompt": "Create a weather widget", "widget_name": "Weather"}),
+        ("/api/user-widgets/edit", {"prompt": "Updated prompt"}),
+    ], ids=["create", "edit"])
+    def test_user_prompt_bypasses_generation_cache(self, client, mock_database_collections, mock_user_widget_doc,
+                                                   mock_ai_generator, path, payload):
+        """Test that creating or editing a widget always asks the model for new HTML."""
+        mock_database_collections["widgets"].find_one.return_value = mock_user_widget_doc
         
-        with patch('main.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_user_widget_doc
-            mock_collection.update_one.return_value = Mock(modified_count=1)
-            
-            response = client.post(
-                "/api/user-widgets/edit",
-                json={
-                    "widget_id": widget_id,
-                    "prompt": "Updated prompt"
-                }
-            )
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert data["success"] is True
-    
-    def test_delete_user_widget_success(self, client, mock_user_widget_doc):
-        """Test successful user widget deletion."""
+        response = client.post(path, json={"widget_id": str(mock_user_widget_doc["_id"]), **payload})
+        assert response.status_code == status.HTTP_200_OK
+        assert mock_ai_generator.call_args.kwargs["use_cache"] is False
+    
+    def test_edit_user_widget_loads_id_only(self, client, mock_database_collections, mock_user_widget_doc):
+        """Test that the existence check before an edit does not load the stored widget HTML."""
+        client.post(
+            "/api/user-widgets/edit",
+            json={"widget_id": str(mock_user_widget_doc["_id"]), "prompt": "Updated prompt"}
+        )
+        
+        query, projection = mock_database_collections["widgets"].find_one.call_args.args
+        assert query == {"_id": mock_user_widget_doc["_id"], "user_created": True}
+        assert projection == {"_id": 1}
+    
+    def test_repeated_refresh_calls_model_each_time(self, client, mock_database_collections, mock_user_widget_doc):
+        """Test that refreshing twice generates twice instead of replaying the generation cache."""
+        mock_database_collections["widgets"].find_one.return_value = mock_user_widget_doc
         widget_id = str(mock_user_widget_doc["_id"])
         
-        with patch('main.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_user_widget_doc
-            mock_collection.delete_one.return_value = Mock(deleted_count=1)
+        with patch('main.generate_widget_html', ai_generator.generate_widget_html), \
+             patch('ai_generator.ANTHROPIC_API_KEY', "test_key"), \
+             patch.dict(ai_generator._widget_cache, clear=True), \
+             patch('ai_generator._call_anthropic_api', return_value="<div>Refreshed</div>") as mock_call:
+            
+            for _ in range(2):
+                response = client.post(f"/api/user-widgets/{widget_id}/refresh")
+                assert response.status_code == status.HTTP_200_OK
             
-            response = client.post(
-                "/api/user-widgets/delete",
-                json={
-                    "widget_id": widget_id
-                }
-            )
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert data["success"] is True
-    
-    def test_refresh_user_widget_success(self, client, mock_user_widget_doc, mock_ai_response):
-        """Test successful user widget refresh."""
+            assert mock_call.await_count == 2
+    
+    def test_full_refresh_user_widget_bypasses_cache(self, client, mock_database_collections,
+                                                     mock_user_widget_doc, mock_ai_generator):
+        """Test that a full refresh regenerates from the original prompt without the generation cache."""
+        mock_database_collections["widgets"].find_one.return_value = mock_user_widget_doc
         widget_id = str(mock_user_widget_doc["_id"])
         
-        with patch('main.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_user_widget_doc
-            mock_collection.update_one.return_value = Mock(modified_count=1)
-            
-            response = client.post(f"/api/user-widgets/{widget_id}/refresh")
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert "html" in data
+        response = client.post(f"/api/user-widgets/{widget_id}/full-refresh")
+        assert response.status_code == status.HTTP_200_OK
+        mock_ai_generator.assert_called_once_with(
+            {}, mock_user_widget_doc["render_prompt"], is_user_prompt=True, use_cache=False
+        )
 
 
 class TestAppWidgets:
     """Tests for app widget endpoints."""
     
-    def test_refresh_app_widget_success(self, client, mock_app_doc, mock_widget_doc, mock_ai_response):
-        """Test successful app widget refresh."""
+    def test_refresh_app_widget_success(self, client, mock_app_doc):
+        """Test successful app widget refresh (widgets.find_one returns the mock app widget by default)."""
         app_id = str(mock_app_doc["_id"])
         
-        with patch('main.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_widget_doc
-            mock_collection.update_one.return_value = Mock(modified_count=1)
-            
-            response = client.post(f"/api/app-widgets/{app_id}/refresh")
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert data["success"] is True
-            assert "html" in data
+        response = client.post(f"/api/app-widgets/{app_id}/refresh")
+        assert response.status_code == status.HTTP_200_OK
+        data = json_body(response)
+        assert data["success"] is True
+        assert "html" in data
     
-    def test_full_refresh_app_widget_success(self, client, mock_app_doc, mock_widget_doc, mock_ai_response):
+    def test_full_refresh_app_widget_success(self, client, mock_app_doc):
         """Test successful app widget full refresh."""
         app_id = str(mock_app_doc["_id"])
         
-        with patch('main.widgets_collection') as mock_collection:
-            mock_collection.find_one.return_value = mock_widget_doc
-            mock_collection.update_one.return_value = Mock(modified_count=1)
-            
-            response = client.post(f"/api/app-widgets/{app_id}/full-refresh")
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert data["success"] is True
+        response = client.post(f"/api/app-widgets/{app_id}/full-refresh")
+        assert response.status_code == status.HTTP_200_OK
+        data = json_body(response)
+        assert data["success"] is True
     
-    def test_delete_app_widget_success(self, client, mock_app_doc, mock_widget_doc):
+    def test_delete_app_widget_success(self, client, mock_database_collections, mock_app_doc):
         """Test successful app widget deletion."""
         app_id = str(mock_app_doc["_id"])
+        mock_apps = mock_database_collections["apps"]
+        mock_widgets = mock_database_collections["widgets"]
         
-        with patch('main.apps_collection') as mock_apps, \
-             patch('main.widgets_collection') as mock_widgets:
-            
-            mock_widgets.find_one.return_value = mock_widget_doc
-            mock_widgets.delete_one.return_value = Mock(deleted_count=1)
-            mock_apps.delete_one.return_value = Mock(deleted_count=1)
-            
-            response = client.delete(f"/api/app-widgets/{app_id}")
-            assert response.status_code == status.HTTP_200_OK
-            data = response.json()
-            assert data["success"] is True
+        response = client.delete(f"/api/app-widgets/{app_id}")
+        assert response.status_code == status.HTTP_200_OK
+        data = json_body(response)
+        assert data["success"] is True
+        mock_widgets.delete_one.assert_awaited_once_with({"app_id": app_id})
+        mock_apps.delete_one.assert_awaited_once_with({"_id": ObjectId(app_id)})
+    
+    def test_delete_app_widget_malformed_id_deletes_nothing(self, client, mock_database_collections):
+        """Test that a malformed app_id is rejected before either delete is issued."""
+        response = client.delete("/api/app-widgets/not-an-object-id")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        mock_database_collections["widgets"].delete_one.assert_not_called()
+        mock_database_collections["apps"].delete_one.assert_not_called()
+    
+    def test_delete_app_widget_app_not_found(self, client, mock_database_collections, mock_app_doc,
+                                             delete_none_result):
+        """Test deleting an app that is not registered."""
+        app_id = str(mock_app_doc["_id"])
+        mock_database_collections["widgets"].delete_one.return_value = delete_none_result
+        mock_database_collections["apps"].delete_one.return_value = delete_none_result
+        
+        response = client.delete(f"/api/app-widgets/{app_id}")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
 
+class TestErrorResponses:
+    """Tests for requests rejected before any widget is generated."""
+    
+    @pytest.mark.parametrize("method, path, body, setup, expected_status, expected_detail", [
+        ("POST", "/register", {"registration_token": "wrong_token", "app_name": "Test App"},
+         no_setup, status.HTTP_401_UNAUTHORIZED, "Invalid registration token"),
+        ("POST", "/share-data",
+         {"integration_token": "invalid_token", "data": {"test": "data"}, "render_prompt": "Create a test widget"},
+         no_setup, status.HTTP_401_UNAUTHORIZED, "Invalid integration token"),
+        ("GET", "/widget/{missing_id}/refresh", None,
+         widget_missing, status.HTTP_404_NOT_FOUND, "Widget not found"),
+        ("POST", "/api/app-widgets/{missing_id}/refresh", None,
+         app_widget_missing, status.HTTP_404_NOT_FOUND, "App widget not found"),
+        ("POST", "/api/user-widgets/not-an-object-id/refresh", None,
+         no_setup, status.HTTP_404_NOT_FOUND, "User widget not found"),
+        ("POST", "/api/user-widgets/not-an-object-id/full-refresh", None,
+         no_setup, status.HTTP_404_NOT_FOUND, "User widget not found"),
+        ("DELETE", "/api/app-widgets/not-an-object-id", None,
+         no_setup, status.HTTP_404_NOT_FOUND, "App not found"),
+    ], ids=["register-invalid-token", "share-data-invalid-token", "widget-not-found", "app-widget-not-found",
+            "user-widget-refresh-malformed-id", "user-widget-full-refresh-malformed-id",
+            "app-widget-delete-malformed-id"])
+    def test_error_responses(self, client, mock_database_collections, dependency_overrides, mock_ai_generator,
+                             missing_object_id, method, path, body, setup, expected_status, expected_detail):
+        """Test status and detail of each error response, and that nothing is generated."""
+        setup(mock_database_collections, dependency_overrides)
+        
+        response = client.request(method, path.format(missing_id=missing_object_id), json=body)
+        assert response.status_code == expected_status
+        assert expected_detail in json_body(response)["detail"]
+        mock_ai_generator.assert_not_called()